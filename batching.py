@@ -0,0 +1,116 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Packing mode changes and message targets into as few lines as possible.
+
+Servers announce in RPL_ISUPPORT how many mode changes fit in one MODE
+(MODES) and how many comma separated targets a command takes (TARGMAX, or
+the older MAXTARGETS).  Every line we save is one less line waiting in the
+flood protection queue, so opping ten people takes three lines instead of
+ten.
+
+"""
+
+
+def size(line):
+    """Length of line on the wire."""
+    if isinstance(line, unicode):
+        return len(line.encode('utf-8'))
+    return len(line)
+
+
+def param_modes(supported):
+    """The channel modes that take a parameter, from ISUPPORT.
+
+    Returns (always, when_set): modes that always take a parameter, such as
+    +o and +b, and those that only take one when they're set, such as +l.
+
+    """
+    chanmodes = supported.getFeature('CHANMODES')
+    always = set(supported.getFeature('PREFIX'))
+    always.update(chanmodes['addressModes'], chanmodes['param'])
+    return always, set(chanmodes['setParam'])
+
+
+# The commands the older MAXTARGETS is about.
+MAXTARGETS_COMMANDS = ('PRIVMSG', 'NOTICE')
+
+
+def max_targets(supported, command):
+    """How many targets command may have, or None for no limit.
+
+    Commands the server doesn't give a limit for get a single target.
+
+    """
+    targmax = supported.getFeature('TARGMAX')
+    if targmax is not None and command in targmax:
+        return targmax[command]
+    maxtargets = supported.getFeature('MAXTARGETS')
+    if maxtargets and command in MAXTARGETS_COMMANDS:
+        try:
+            return int(maxtargets[0])
+        except ValueError:
+            pass
+    return 1
+
+
+def mode_lines(channel, changes, per_line, always, when_set, max_length):
+    """Pack changes into MODE lines for channel.
+
+    changes are strings like '+o nick', '-b *!*@host' or '+m'.  Each line
+    has at most per_line changes and is at most max_length long.  Raises
+    ValueError for a change that's missing its parameter.
+
+    """
+    lines = []
+    modes = params = sign = None
+    count = 0
+    for change in changes:
+        flag, _, param = change.partition(' ')
+        if len(flag) != 2 or flag[0] not in '+-':
+            raise ValueError('Bad mode change %r' % (change,))
+        needs = flag[1] in always or (flag[0] == '+' and flag[1] in when_set)
+        if needs and not param:
+            raise ValueError('Mode change %r needs a parameter' % (change,))
+        if not needs:
+            param = ''
+        if modes is not None:
+            extra = (flag[1] if flag[0] == sign else flag) + \
+                (' ' + param if param else '')
+            if count == per_line or size(
+                    ' '.join(['MODE', channel, modes] + params)) + \
+                    size(extra) > max_length:
+                lines.append(' '.join(['MODE', channel, modes] + params))
+                modes = None
+        if modes is None:
+            modes, params, sign, count = '', [], None, 0
+        if flag[0] != sign:
+            modes += flag[0]
+            sign = flag[0]
+        modes += flag[1]
+        if param:
+            params.append(param)
+        count += 1
+    if modes is not None:
+        lines.append(' '.join(['MODE', channel, modes] + params))
+    return lines
+
+
+def target_lines(command, targets, text, per_line, max_length):
+    """Pack targets into lines of 'command target,target,... :text'.
+
+    per_line is the most targets a line may have, or None for no limit.  A
+    line always has at least one target, however long text is.
+
+    """
+    lines = []
+    batch = []
+    for target in targets:
+        if batch and (len(batch) == per_line or size('%s %s,%s :%s'
+                % (command, ','.join(batch), target, text)) > max_length):
+            lines.append('%s %s :%s' % (command, ','.join(batch), text))
+            batch = []
+        batch.append(target)
+    if batch:
+        lines.append('%s %s :%s' % (command, ','.join(batch), text))
+    return lines
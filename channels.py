@@ -0,0 +1,314 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""What Shirk knows about the channels it's in.
+
+Channels keeps each channel's modes, topic, ban list and the status (op,
+voice, ...) of everyone in it, so plugs can ask who's opped or whether a
+hostmask is banned without sending MODE or NAMES and parsing the replies.
+It starts from the NAMES, RPL_CHANNELMODEIS and ban list replies after a
+join and is kept up to date from JOIN, PART, KICK, QUIT, NICK, MODE and
+TOPIC.
+
+"""
+
+import logging
+import re
+
+
+def mask_regex(mask):
+    """Regex source for an IRC wildcard mask, * and ? being the wildcards."""
+    return ''.join('.*' if char == '*' else '.' if char == '?'
+                   else re.escape(char) for char in mask)
+
+
+class BanMatcher(object):
+    """Compiled form of a ban list.
+
+    Bans without wildcards are looked up in a set and *!*@host bans in a
+    dict on the host; the rest are or'ed into a single regex.  Extended bans
+    like $a:account aren't hostmasks and never match.
+
+    """
+    def __init__(self, masks):
+        self.exact = set()
+        self.hosts = set()
+        patterns = []
+        for mask in masks:
+            if mask[:1] in '$~' or '!' not in mask or '@' not in mask:
+                continue
+            wild = '*' in mask or '?' in mask
+            if not wild:
+                self.exact.add(mask)
+            elif mask.startswith('*!*@') and not re.search(r'[*?]', mask[4:]):
+                self.hosts.add(mask[4:])
+            else:
+                patterns.append(mask_regex(mask))
+        self.regex = None
+        if patterns:
+            self.regex = re.compile('(?:%s)\\Z' % ('|'.join(patterns),),
+                                    re.S)
+
+    def match(self, hostmask):
+        """Whether the folded nick!user@host is banned."""
+        if hostmask in self.exact:
+            return True
+        if hostmask.rpartition('@')[2] in self.hosts:
+            return True
+        return self.regex is not None and self.regex.match(hostmask) \
+            is not None
+
+
+class Channel(object):
+    """A channel the bot is in.
+
+    modes maps the channel's mode letters to their parameter, or None for
+    modes without one.  members maps the folded nicknames of the users in
+    the channel to the set of status modes (o, v, ...) they have, and
+    nicknames maps them to the nicknames as the server spelled them.
+    status is the other way around, {mode: set of folded nicknames}, so
+    listing the ops doesn't mean going through everyone.  Use the methods
+    below to change members, they keep the three in step.  bans
+    maps folded ban masks to the masks as set; bans_known is False until the
+    ban list has come in, as not every server lets us see it.
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.modes = {}
+        self.topic = None
+        self.members = {}
+        self.nicknames = {}
+        self.status = {}
+        self.bans = {}
+        self.bans_known = False
+        # Bans coming in from RPL_BANLIST until RPL_ENDOFBANLIST
+        self.incoming_bans = None
+        self.matcher = None
+
+    def add(self, key, nickname, status=()):
+        """Add a member, or replace what we knew about them."""
+        self.remove(key)
+        self.members[key] = set()
+        self.nicknames[key] = nickname
+        for mode in status:
+            self.set_status(key, mode, True)
+
+    def remove(self, key):
+        for mode in self.members.pop(key, ()):
+            self.status[mode].discard(key)
+        self.nicknames.pop(key, None)
+
+    def rename(self, old, new, nickname):
+        if old not in self.members:
+            return
+        status = self.members[old]
+        self.remove(old)
+        self.add(new, nickname, status)
+
+    def set_status(self, key, mode, adding):
+        member = self.members.get(key)
+        if member is None:
+            return
+        if adding:
+            member.add(mode)
+            self.status.setdefault(mode, set()).add(key)
+        else:
+            member.discard(mode)
+            self.status.get(mode, set()).discard(key)
+
+
+class Channels(object):
+    """Channel state for Shirk, kept next to users.Users.
+
+    Nicknames, channel names and masks are casefolded with core.users.fold,
+    so lookups follow the server's CASEMAPPING.  Which modes are status
+    modes, list modes or take a parameter comes from the server's PREFIX and
+    CHANMODES, as parsed by Twisted.
+
+    """
+    def __init__(self, core):
+        self.log = logging.getLogger('Channels')
+        self.core = core
+        # {folded channel: Channel}
+        self.channels = {}
+
+    def fold(self, name):
+        return self.core.users.fold(name)
+
+    def get(self, channel):
+        """The Channel for channel, or None if we're not in it."""
+        return self.channels.get(self.fold(channel))
+
+    def status_modes(self):
+        """{status prefix: mode letter}, like {'@': 'o', '+': 'v'}."""
+        return dict((prefix, mode) for mode, (prefix, priority)
+            in self.core.supported.getFeature('PREFIX', {}).iteritems())
+
+    # Updates
+
+    def joined(self, channel):
+        """We joined channel."""
+        self.channels[self.fold(channel)] = Channel(channel)
+
+    def left(self, channel):
+        """We left or were kicked from channel."""
+        self.channels.pop(self.fold(channel), None)
+
+    def refold(self):
+        """Rekey everything after the casemapping changed."""
+        channels = self.channels.values()
+        self.channels = {}
+        for chan in channels:
+            self.channels[self.fold(chan.name)] = chan
+            members, nicknames = chan.members, chan.nicknames
+            chan.members, chan.nicknames, chan.status = {}, {}, {}
+            for key, status in members.iteritems():
+                nickname = nicknames.get(key, key)
+                chan.add(self.fold(nickname), nickname, status)
+            chan.bans = dict((self.fold(mask), mask)
+                             for mask in chan.bans.itervalues())
+            if chan.incoming_bans is not None:
+                chan.incoming_bans = dict(
+                    (self.fold(mask), mask)
+                    for mask in chan.incoming_bans.itervalues())
+            chan.matcher = None
+
+    def names(self, channel, entries):
+        """A line of NAMES reply, entries still carrying their prefixes."""
+        chan = self.get(channel)
+        if chan is None:
+            return
+        prefixes = self.status_modes()
+        for entry in entries:
+            status = set()
+            while entry[:1] in prefixes:
+                status.add(prefixes[entry[0]])
+                entry = entry[1:]
+            nickname = entry.split('!', 1)[0]
+            if nickname:
+                chan.add(self.fold(nickname), nickname, status)
+
+    def user_joined(self, nickname, channel):
+        chan = self.get(channel)
+        if chan is not None:
+            chan.add(self.fold(nickname), nickname)
+
+    def user_left(self, nickname, channel):
+        chan = self.get(channel)
+        if chan is not None:
+            chan.remove(self.fold(nickname))
+
+    def user_quit(self, nickname):
+        key = self.fold(nickname)
+        for chan in self.channels.itervalues():
+            chan.remove(key)
+
+    def user_renamed(self, oldname, newname):
+        old, new = self.fold(oldname), self.fold(newname)
+        for chan in self.channels.itervalues():
+            chan.rename(old, new, newname)
+
+    def mode_changed(self, channel, adding, modes, args):
+        """Modes were set or unset on channel, args lined up with modes."""
+        chan = self.get(channel)
+        if chan is None:
+            return
+        status = set(self.core.supported.getFeature('PREFIX', {}))
+        lists = set(self.core.supported.getFeature('CHANMODES')
+                    ['addressModes'])
+        for mode, arg in zip(modes, args):
+            if mode in status:
+                chan.set_status(self.fold(arg), mode, adding)
+            elif mode == 'b':
+                if adding:
+                    chan.bans[self.fold(arg)] = arg
+                else:
+                    chan.bans.pop(self.fold(arg), None)
+                chan.matcher = None
+            elif mode in lists:
+                # Exceptions, invite exceptions, quiets: not kept.
+                pass
+            elif adding:
+                chan.modes[mode] = arg
+            else:
+                chan.modes.pop(mode, None)
+
+    def channel_modes(self, channel, modes, args):
+        """RPL_CHANNELMODEIS: the full set of channel modes."""
+        chan = self.get(channel)
+        if chan is None:
+            return
+        chan.modes = {}
+        args = list(args)
+        params = set(self.core.supported.getFeature('CHANMODES')['param'])
+        params.update(self.core.supported.getFeature('CHANMODES')['setParam'])
+        for mode in modes.lstrip('+'):
+            chan.modes[mode] = args.pop(0) if mode in params and args \
+                else None
+
+    def ban_listed(self, channel, mask):
+        """One entry of the ban list."""
+        chan = self.get(channel)
+        if chan is not None:
+            if chan.incoming_bans is None:
+                chan.incoming_bans = {}
+            chan.incoming_bans[self.fold(mask)] = mask
+
+    def ban_list_end(self, channel):
+        chan = self.get(channel)
+        if chan is not None:
+            chan.bans = chan.incoming_bans or {}
+            chan.incoming_bans = None
+            chan.bans_known = True
+            chan.matcher = None
+
+    def topic_changed(self, channel, topic):
+        chan = self.get(channel)
+        if chan is not None:
+            chan.topic = topic
+
+    # Queries
+
+    def members(self, channel):
+        """Folded nicknames of everyone in channel."""
+        chan = self.get(channel)
+        return set(chan.members) if chan is not None else set()
+
+    def with_status(self, channel, mode):
+        """Folded nicknames of everyone in channel with the status mode."""
+        chan = self.get(channel)
+        if chan is None:
+            return set()
+        return set(chan.status.get(mode, ()))
+
+    def ops(self, channel):
+        return self.with_status(channel, 'o')
+
+    def voiced(self, channel):
+        return self.with_status(channel, 'v')
+
+    def has_status(self, nickname, channel, mode):
+        chan = self.get(channel)
+        if chan is None:
+            return False
+        return mode in chan.members.get(self.fold(nickname), ())
+
+    def is_op(self, nickname, channel):
+        return self.has_status(nickname, channel, 'o')
+
+    def is_voiced(self, nickname, channel):
+        return self.has_status(nickname, channel, 'v')
+
+    def is_banned(self, channel, hostmask):
+        """Whether nick!user@host matches a ban on channel.
+
+        Returns None rather than False if the ban list isn't known.
+
+        """
+        chan = self.get(channel)
+        if chan is None or not chan.bans_known:
+            return None
+        if chan.matcher is None:
+            chan.matcher = BanMatcher(chan.bans)
+        return chan.matcher.match(self.fold(hostmask))
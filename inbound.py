@@ -0,0 +1,156 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Keeping a flood of incoming lines from starving everything else.
+
+A netjoin, a big WHO reply or a spam wave can bring in thousands of lines
+at once.  Handling them all in one go keeps the reactor from doing
+anything else, PINGs go unanswered and we time out.  Inbound handles lines
+as they come in for up to slice_time seconds per reactor turn; after that
+they're queued and worked off a slice at a time, with the reactor getting
+a turn in between.
+
+Some lines skip the queue: PING and other connection business, server
+numerics other than the bulk replies to our own queries, and !commands
+from users with at least fast_power.  Everything else is handled in order.
+
+If the queue grows past high_water, we stop reading from the socket until
+it's down to low_water again.  Past lossy_water, plugs that set lossy
+stop getting chanmsg events until the queue has shrunk back.
+
+"""
+
+import collections
+import logging
+import time
+
+from twisted.internet import reactor
+
+import queries
+
+
+# Commands that are about the connection rather than the channels
+FAST_COMMANDS = set(['PING', 'PONG', 'ERROR', 'CAP', 'AUTHENTICATE'])
+# Numerics that come in bulk, or that have to stay in order with those
+BULK_NUMERICS = set(['331', '332', '333'])
+for line, replies, ends in queries.QUERIES.itervalues():
+    BULK_NUMERICS.update(replies + ends)
+
+
+class Inbound(object):
+    """Schedules the handling of incoming lines for one connection.
+
+    core: the Shirk instance; lines are handed to core.handle_line.
+    slice_time: seconds of line handling per reactor turn.
+    high_water, low_water: queue lengths at which reading from the socket
+        is paused and resumed.
+    lossy_water: queue length past which lossy plugs miss chanmsg events.
+    fast_power: power a user needs for their !commands to skip the queue.
+
+    """
+    def __init__(self, core, slice_time=0.05, high_water=5000,
+                 low_water=1000, lossy_water=1000, fast_power=10):
+        self.log = logging.getLogger('Inbound')
+        self.core = core
+        self.slice_time = slice_time
+        self.high_water = high_water
+        self.low_water = low_water
+        self.lossy_water = lossy_water
+        self.fast_power = fast_power
+        self.queue = collections.deque()
+        # When the current slice of handling lines as they come in ends
+        self.slice_end = None
+        self.drainer = None
+        self.paused = False
+        # Counters, for !inbound
+        self.fast = 0
+        self.direct = 0
+        self.queued = 0
+        self.peak = 0
+        self.pauses = 0
+        self.dropped = collections.Counter()
+
+    def received(self, tags, prefix, command, params):
+        """A line came in, handle it now or queue it."""
+        line = (tags, prefix, command, params)
+        if self.is_fast(prefix, command, params):
+            self.fast += 1
+            self.core.handle_line(*line)
+        elif not self.queue and self.in_slice():
+            self.direct += 1
+            self.core.handle_line(*line)
+        else:
+            self.queue.append(line)
+            self.queued += 1
+            self.peak = max(self.peak, len(self.queue))
+            if len(self.queue) >= self.high_water and not self.paused:
+                self.log.warning('%d lines queued, pausing reading'
+                    % (len(self.queue),))
+                self.paused = True
+                self.pauses += 1
+                # Only the socket: what's already been read is at most one
+                # chunk, and may hold a PING.
+                self.core.transport.pauseProducing()
+            if self.drainer is None:
+                self.drainer = reactor.callLater(0, self.drain)
+
+    def is_fast(self, prefix, command, params):
+        if command in FAST_COMMANDS or not self.core._registered:
+            return True
+        if command.isdigit():
+            return command not in BULK_NUMERICS
+        if command == 'PRIVMSG' and params \
+                and params[-1].startswith(self.core.cmd_prefix):
+            user = self.core.users.by_nick(prefix.split('!', 1)[0])
+            return getattr(user, 'power', 0) >= self.fast_power
+        return False
+
+    def in_slice(self):
+        """Whether this reactor turn still has time for handling lines."""
+        now = time.time()
+        if self.slice_end is None:
+            self.slice_end = now + self.slice_time
+            reactor.callLater(0, self.end_slice)
+        return now < self.slice_end
+
+    def end_slice(self):
+        self.slice_end = None
+
+    def drain(self):
+        """Handle queued lines for one slice, then give the reactor a turn."""
+        self.drainer = None
+        end = time.time() + self.slice_time
+        while self.queue and time.time() < end:
+            try:
+                self.core.handle_line(*self.queue.popleft())
+            except Exception:
+                self.log.exception('Error handling a queued line')
+        if self.paused and len(self.queue) <= self.low_water:
+            self.log.info('Down to %d queued lines, reading again'
+                % (len(self.queue),))
+            self.paused = False
+            self.core.transport.resumeProducing()
+        if self.queue:
+            self.drainer = reactor.callLater(0, self.drain)
+
+    def overloaded(self):
+        return len(self.queue) >= self.lossy_water
+
+    def shed(self, plugs):
+        """Leave the lossy plugs out of plugs while overloaded."""
+        if not self.overloaded():
+            return plugs
+        kept = set()
+        for plug in plugs:
+            if plug.lossy:
+                self.dropped[plug.name] += 1
+            else:
+                kept.add(plug)
+        return kept
+
+    def stop(self):
+        """Forget the queue, for when the connection's gone."""
+        if self.drainer is not None and self.drainer.active():
+            self.drainer.cancel()
+        self.drainer = None
+        self.queue.clear()
@@ -0,0 +1,138 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Measuring the lag to the server and pacing what Shirk sends by it.
+
+Twisted's heartbeat PINGs the server every so often; LagMeter puts a
+timestamp in those PINGs, keeps a smoothed round-trip time and a short
+history of them, and adjusts the delay between outgoing lines.  A lagged
+link means the server is sitting on what we already sent, so we slow down;
+once it's quick again we go back to the configured pace, but never faster
+than that.  Flood warnings from the server make us back off right away.
+
+If a PING goes unanswered for too long the connection is dropped, so the
+factory reconnects instead of waiting for TCP to give up.
+
+"""
+
+import collections
+import logging
+import time
+
+from twisted.internet import reactor
+
+# The shortest delay between lines, in seconds, whatever the config says.
+# Servers' flood limits don't forgive much faster than this.
+MIN_RATE = 0.3
+
+
+class LagMeter(object):
+    """Lag bookkeeping and send pacing for one connection.
+
+    interval: seconds between PINGs.
+    timeout: seconds to wait for a PONG before giving up on the connection.
+    history: number of round-trip times to remember.
+    rate: delay between outgoing lines, in seconds, when there's no lag.
+    min_rate, max_rate: bounds on how far the delay is adjusted; min_rate
+        is never below MIN_RATE.
+    low_lag, high_lag: above high_lag the delay grows, below low_lag it
+        shrinks back towards rate.
+    warn_lag: lag that's worth a warning in the logs.
+
+    """
+    # Weight of the newest round trip in the smoothed one
+    alpha = 0.25
+
+    def __init__(self, core, interval=30, timeout=90, history=20, rate=0.3,
+                 min_rate=MIN_RATE, max_rate=2, low_lag=0.5, high_lag=2,
+                 warn_lag=5):
+        self.log = logging.getLogger('Lag')
+        self.core = core
+        self.interval = interval
+        self.timeout = timeout
+        self.min_rate = max(MIN_RATE, min_rate)
+        self.base_rate = max(self.min_rate, rate)
+        self.rate = self.base_rate
+        self.max_rate = max_rate
+        self.low_lag = low_lag
+        self.high_lag = high_lag
+        self.warn_lag = warn_lag
+        self.history = collections.deque(maxlen=history)
+        self.srtt = None
+        # Token and send time of the PING we're waiting on, if any
+        self.token = None
+        self.sent = None
+        self.deadline = None
+
+    def ping(self):
+        """Send a timestamped PING, unless one is still unanswered."""
+        if self.sent is not None:
+            return
+        self.sent = time.time()
+        self.token = 'LAG%d' % (self.sent * 1000,)
+        # Straight to the transport: time spent in our own send queue isn't
+        # lag, and the PING shouldn't wait for the replies ahead of it.
+        self.core.send_now('PING :%s' % (self.token,))
+        self.deadline = reactor.callLater(self.timeout, self.timed_out)
+
+    def pong(self, token):
+        """Handle a PONG; returns whether it answered one of our PINGs."""
+        if self.sent is None or token != self.token:
+            return False
+        rtt = time.time() - self.sent
+        self.sent = self.token = None
+        self.deadline.cancel()
+        self.deadline = None
+        self.history.append(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += self.alpha * (rtt - self.srtt)
+        self.adapt()
+        if rtt >= self.warn_lag:
+            self.log.warning('Lagging %.1fs behind the server' % (rtt,))
+        else:
+            self.log.debug('Lag %.3fs, smoothed %.3fs, sending every %.2fs'
+                % (rtt, self.srtt, self.rate))
+        return True
+
+    def lag(self):
+        """The current lag in seconds, or None if it isn't known yet.
+
+        That's the smoothed round-trip time, or how long the outstanding PING
+        has been waiting if that's longer.
+
+        """
+        waiting = time.time() - self.sent if self.sent is not None else 0
+        if self.srtt is None:
+            return waiting or None
+        return max(self.srtt, waiting)
+
+    def adapt(self):
+        if self.srtt > self.high_lag:
+            self.set_rate(self.rate * 1.5)
+        elif self.srtt < self.low_lag and self.rate > self.base_rate:
+            # Only ever undo the slowing down lag made us do.
+            self.set_rate(max(self.base_rate, self.rate * 0.9))
+
+    def flooding(self, reason):
+        """The server complained that we're sending too fast."""
+        self.log.warning('Server says we\'re flooding (%s), slowing down'
+            % (reason,))
+        self.set_rate(self.rate * 2)
+
+    def set_rate(self, rate):
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        if self.core.lineRate is not None:
+            self.core.lineRate = self.rate
+
+    def timed_out(self):
+        self.deadline = None
+        self.log.warning('No PONG in %s seconds, reconnecting'
+            % (self.timeout,))
+        self.core.transport.abortConnection()
+
+    def stop(self):
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+        self.deadline = None
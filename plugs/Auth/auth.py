@@ -1,41 +1,119 @@
 # Copyright (c) 2012 Dominic van Berkel
 # See LICENSE for details.
 
+from twisted.internet import defer
+
 from plugs import plugbase
 from util import Event
 
 import json
 
+import hostindex
+reload(hostindex)
+import powercache
+reload(powercache)
+
 
 class AuthPlug(plugbase.Plug):
-    """Auth plug.  Handles auth stuffs."""
+    """Auth plug.  Handles auth stuffs.
+
+    Powers granted through an account are remembered in a PowerCache, so
+    after a restart known users get their power back straight away and are
+    only re-WHOISed once their entry is older than cache_refresh.  When the
+    server does extended-join and account-notify there's no need to WHOIS
+    at all: accounts arrive with the JOIN and every change is pushed to us.
+
+    """
     name = 'Auth'
-    hooks = [Event.usercreated]
-    rawhooks = ['330']
+    hooks = [Event.usercreated, Event.useraccount, Event.casemapping]
+    # Auth-specific options
+    cache_path = 'auth-cache.db'
+    # Seconds before a cached power is refreshed and before it is dropped.
+    cache_refresh = 3600
+    cache_ttl = 7 * 86400
 
     def load(self, startingup=True):
-        """Force reloading the userlist in case the plug is reloaded"""
+        """Compile hosts_auth and, if the plug is reloaded, redo the
+        userlist.
+
+        """
+        self.host_index = hostindex.HostIndex(self.hosts_auth)
+        self.fold_known_nicks()
+        self.cache = powercache.PowerCache(self.cache_path, self.cache_ttl)
         if not startingup:
             for nick, user in self.users.users_by_nick.iteritems():
                 self.handle_usercreated(user)
 
+    def fold_known_nicks(self):
+        """Fold known_nicks with the current casemapping.
+
+        The nicks as configured are kept, as 005 CASEMAPPING usually comes
+        in after the plug has loaded.
+
+        """
+        self.known_nicks_folded = [self.users.fold(nick)
+                                   for nick in self.known_nicks]
+
+    def handle_casemapping(self):
+        self.fold_known_nicks()
+
+    def cleanup(self):
+        self.cache.close()
+        plugbase.Plug.cleanup(self)
+
     def handle_usercreated(self, user):
         """A user has joined a channel, so let's give them perms."""
         user.power = 0
-        if user.hostmask in self.hosts_auth:
-            user.power = self.hosts_auth[user.hostmask]
+        power = self.host_index.match(user.hostmask)
+        if power is not None:
+            user.power = power
             self.log.info('Power of %s set to %d based on hostmask: %s'
                 % (user.nickname, user.power, user.hostmask))
-        for nick in self.known_nicks:
-            if user.nickname.lower().startswith(nick):
-                self.core.sendLine('WHOIS %s' % (user.nickname,))
-
-    def raw_330(self, command, prefix, params):
-        """RPL code for Freenode's "logged in as" message on whois."""
-        nickname = params[1]
-        account = params[2]
+        user.host_power = user.power
+        if user.account is not None:
+            # Came in through extended-join, no need to look any further.
+            self.set_account(user, user.account)
+            return
+        cached = self.cache.lookup(user.key, user.hostmask)
+        if cached is not None:
+            account, power, age = cached
+            user.power = max(user.host_power, power)
+            self.log.info('Power of %s set to %d based on cached account: %s'
+                % (user.nickname, user.power, account))
+            if age < self.cache_refresh:
+                return
+        for nick in self.known_nicks_folded:
+            if user.key.startswith(nick):
+                d = self.track(self.core.whois(user.nickname))
+                d.addCallback(self.whois_done, user)
+                d.addErrback(self.whois_failed, user)
+                break
+
+    def set_account(self, user, account):
+        """Set user's power according to the account they're logged in as.
+
+        account is '*' when the user isn't logged in.
+
+        """
+        user.account = account
         if account in self.users_auth:
-            user = self.users.by_nick(nickname)
             user.power = self.users_auth[account]
+            self.cache.store(user.key, user.hostmask, account, user.power)
             self.log.info('Power of %s set to %d based on account: %s'
-                % (nickname, user.power, account))
+                % (user.nickname, user.power, account))
+        else:
+            user.power = user.host_power
+            self.cache.forget(user.key)
+
+    def whois_done(self, info, user):
+        """The WHOIS for user came back.  No account means not logged in."""
+        if info is not None and user.alive:
+            self.set_account(user, info['account'] or '*')
+
+    def whois_failed(self, failure, user):
+        failure.trap(defer.TimeoutError, defer.CancelledError)
+        self.log.info('No WHOIS reply for %s' % (user.nickname,))
+
+    def handle_useraccount(self, user):
+        """account-notify told us the user logged in or out."""
+        self.set_account(user, user.account)
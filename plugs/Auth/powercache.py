@@ -0,0 +1,63 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""On-disk cache of nickname -> account -> power for Auth.
+
+Entries are bound to the hostmask they were seen with, so a cached power is
+only handed out to the same nick coming from the same host.  The whole table
+is small enough to keep in memory; SQLite is just there so it survives
+restarts.  Nicknames are expected to come in casefolded already.
+
+"""
+
+import sqlite3
+import time
+
+
+class PowerCache(object):
+    """Persistent {nick: (hostmask, account, power, checked)} table.
+
+    ttl: Seconds after which an entry is no longer trusted at all.
+
+    """
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS powers ('
+                        'nick TEXT PRIMARY KEY, hostmask TEXT, account TEXT, '
+                        'power INTEGER, checked REAL)')
+        self.db.execute('DELETE FROM powers WHERE checked < ?',
+                        (time.time() - ttl,))
+        self.db.commit()
+        self.entries = {}
+        for row in self.db.execute('SELECT * FROM powers'):
+            self.entries[row[0]] = row[1:]
+
+    def lookup(self, nick, hostmask):
+        """Return (account, power, age) for nick, or None.
+
+        Misses if the entry was stored for another hostmask or has expired.
+
+        """
+        entry = self.entries.get(nick)
+        if entry is None or entry[0] != hostmask:
+            return None
+        age = time.time() - entry[3]
+        if age > self.ttl:
+            return None
+        return entry[1], entry[2], age
+
+    def store(self, nick, hostmask, account, power):
+        entry = (hostmask, account, power, time.time())
+        self.entries[nick] = entry
+        self.db.execute('INSERT OR REPLACE INTO powers VALUES (?, ?, ?, ?, ?)',
+                        (nick,) + entry)
+        self.db.commit()
+
+    def forget(self, nick):
+        if self.entries.pop(nick, None) is not None:
+            self.db.execute('DELETE FROM powers WHERE nick = ?', (nick,))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
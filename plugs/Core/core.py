@@ -15,20 +15,46 @@ class CorePlug(plugbase.Plug):
 
     """
     name = 'Core'
-    commands = ['plugs', 'commands', 'raw', 'quit', 'reload', 'hooks']
+    commands = ['plugs', 'commands', 'raw', 'quit', 'reload', 'hooks', 'lag',
+                'inbound']
 
+    @plugbase.cached
     def cmd_commands(self, source, target, argv):
         """List registered commands."""
         # Only list those commands that have any plugs
-        response = ', '.join([cmd for cmd
+        return ', '.join([cmd for cmd
             in self.core.hooks[Event.command].keys()
             if self.core.hooks[Event.command][cmd]])
-        self.respond(source, target, response)
 
+    @plugbase.cached
     def cmd_plugs(self, source, target, argv):
-        """List the loaded plugs"""
-        response = ', '.join(self.core.plugs)
-        self.respond(source, target, response)
+        """List the loaded plugs, marking those that are still stubs."""
+        return ', '.join([name if plug.loaded else name + ' (idle)'
+            for name, plug in self.core.plugs.iteritems()])
+
+    def cmd_lag(self, source, target, argv):
+        """Show the lag to the server and the current send pace."""
+        meter = self.core.lag
+        current = meter.lag()
+        if current is None:
+            self.respond(source, target, 'Lag unknown so far.')
+            return
+        self.respond(source, target,
+            'Lag %.3fs (last %d: %.3fs to %.3fs), one line per %.2fs.'
+            % (current, len(meter.history), min(meter.history or [current]),
+               max(meter.history or [current]), meter.rate))
+
+    def cmd_inbound(self, source, target, argv):
+        """Show how incoming lines have been handled."""
+        inbound = self.core.inbound
+        dropped = ', '.join('%s %d' % item
+                            for item in inbound.dropped.most_common())
+        self.respond(source, target,
+            '%d queued now (peak %d%s); %d fast, %d direct, %d queued; '
+            'dropped for lossy plugs: %s.'
+            % (len(inbound.queue), inbound.peak,
+               ', reading paused' if inbound.paused else '', inbound.fast,
+               inbound.direct, inbound.queued, dropped or 'none'))
 
     @plugbase.level(12)
     def cmd_quit(self, source, target, argv):
@@ -74,3 +100,6 @@ class CorePlug(plugbase.Plug):
         """
         for ev, hooks in self.core.hooks.iteritems():
             print ev, hooks
+        for ev, subs in self.core.subscriptions.subscriptions.iteritems():
+            for sub in subs:
+                print ev, sub.plug, sub.channels, sub.nicks, sub.prefixes
@@ -0,0 +1,171 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import re
+import time
+from collections import OrderedDict
+
+from twisted.enterprise import adbapi
+
+from plugs import plugbase
+
+
+def create_tables(txn):
+    # name is the primary key, so its index serves both lookups and the
+    # prefix ranges of !factoid find.
+    txn.execute('CREATE TABLE IF NOT EXISTS factoids ('
+                'name TEXT PRIMARY KEY, value TEXT, author TEXT, '
+                'time INTEGER)')
+
+
+def write_batch(txn, changes):
+    """Store a batch of [(name, (value, author, time) or None)]."""
+    txn.executemany('INSERT OR REPLACE INTO factoids VALUES (?, ?, ?, ?)',
+                    [(name,) + entry for name, entry in changes
+                     if entry is not None])
+    txn.executemany('DELETE FROM factoids WHERE name = ?',
+                    [(name,) for name, entry in changes if entry is None])
+
+
+def prefix_end(prefix):
+    """The first string after every string starting with prefix."""
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+class FactoidPlug(plugbase.Plug):
+    """!learn/?factoid, backed by SQLite.
+
+    The most recently used factoids, and names that turned out not to be
+    factoids, are kept in an LRU of cache_size entries, so popular ones never
+    touch the database.  Everything else is looked up in adbapi's thread.
+    Changes go into the cache right away and are written out in one
+    transaction every write_interval seconds.
+
+    """
+    name = 'Factoid'
+    commands = ['learn', 'forget', 'factoid']
+    triggers = [re.compile(r'^\?(\S+)\s*$')]
+    # Factoid-specific options
+    db_path = 'factoids.db'
+    cache_size = 1000
+    write_interval = 1
+    page_size = 10
+
+    def load(self, startingup=True):
+        # A single connection keeps writes and the queries after them in
+        # order.
+        self.db = adbapi.ConnectionPool('sqlite3', self.db_path,
+            check_same_thread=False, cp_min=1, cp_max=1)
+        self.db.runInteraction(create_tables).addErrback(self.db_failed)
+        # {name: value, or None if there's no such factoid}
+        self.cache = OrderedDict()
+        # {name: (value, author, time), or None to delete it}
+        self.unsaved = {}
+        self.every(self.write_interval, self.flush)
+
+    def cleanup(self):
+        if self.core is None:
+            # Already cleaned up: a !quit does, and then the lost
+            # connection does again.
+            return
+        self.flush()
+        self.db.close()
+        plugbase.Plug.cleanup(self)
+
+    def db_failed(self, failure):
+        self.log.error('Database error:\n%s' % (failure.getTraceback(),))
+
+    def flush(self):
+        if self.unsaved:
+            changes, self.unsaved = self.unsaved.items(), {}
+            self.db.runInteraction(write_batch, changes).addErrback(
+                self.db_failed)
+
+    def remember(self, name, value):
+        self.cache.pop(name, None)
+        self.cache[name] = value
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def change(self, name, entry):
+        self.unsaved[name] = entry
+        self.remember(name, entry[0] if entry is not None else None)
+
+    def handle_trigger(self, source, target, msg, trigger, match):
+        name = match.group(1).lower()
+        if name not in self.cache and name in self.unsaved:
+            # Changed, but pushed out of the cache before it was written.
+            entry = self.unsaved[name]
+            self.remember(name, entry[0] if entry is not None else None)
+        if name in self.cache:
+            value = self.cache.pop(name)
+            self.cache[name] = value
+            if value is not None:
+                self.respond(source, target, '%s: %s' % (name, value))
+            return
+        d = self.db.runQuery('SELECT value FROM factoids WHERE name = ?',
+                             (name,))
+        d.addCallback(self.looked_up, name, source, target)
+        return d
+
+    def looked_up(self, rows, name, source, target):
+        value = rows[0][0] if rows else None
+        # Don't undo a change made while the query was running.
+        if name not in self.cache and name not in self.unsaved:
+            self.remember(name, value)
+        else:
+            value = self.cache.get(name)
+        if value is not None:
+            self.respond(source, target, '%s: %s' % (name, value))
+
+    @plugbase.level(5)
+    def cmd_learn(self, source, target, argv):
+        """!learn <name> [is] <text>: teach (or reteach) a factoid."""
+        if len(argv) < 3:
+            self.respond(source, target, 'Usage: !learn <name> <text>')
+            return
+        name = argv[1].lower()
+        text = argv[2:]
+        if text[0] == 'is' and len(text) > 1:
+            text = text[1:]
+        self.change(name, (' '.join(text), source, int(time.time())))
+        self.respond(source, target, 'Okay, learned %s.' % (name,))
+
+    @plugbase.level(5)
+    def cmd_forget(self, source, target, argv):
+        """!forget <name>: remove a factoid."""
+        if len(argv) < 2:
+            self.respond(source, target, 'Usage: !forget <name>')
+            return
+        name = argv[1].lower()
+        self.change(name, None)
+        self.respond(source, target, 'Okay, forgot %s.' % (name,))
+
+    def cmd_factoid(self, source, target, argv):
+        """!factoid find <prefix> [page]: list factoids by name."""
+        if len(argv) < 3 or argv[1] != 'find':
+            self.respond(source, target,
+                         'Usage: !factoid find <prefix> [page]')
+            return
+        prefix = argv[2].lower()
+        page = int(argv[3]) if len(argv) > 3 and argv[3].isdigit() else 1
+        page = max(1, page)
+        # Let the query see what's been learned since the last write.
+        self.flush()
+        d = self.db.runQuery('SELECT name FROM factoids '
+                             'WHERE name >= ? AND name < ? '
+                             'ORDER BY name LIMIT ? OFFSET ?',
+                             (prefix, prefix_end(prefix), self.page_size + 1,
+                              (page - 1) * self.page_size))
+        d.addCallback(self.found, prefix, page, source, target)
+        return d
+
+    def found(self, rows, prefix, page, source, target):
+        if not rows:
+            self.respond(source, target, 'No factoids starting with %s.'
+                % (prefix,))
+            return
+        names = ', '.join(row[0] for row in rows[:self.page_size])
+        if len(rows) > self.page_size:
+            names += ' (more with !factoid find %s %d)' % (prefix, page + 1)
+        self.respond(source, target, names)
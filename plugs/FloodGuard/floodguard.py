@@ -0,0 +1,139 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import time
+
+from plugs import plugbase
+from util import Event
+
+import detector
+reload(detector)
+
+
+class FloodGuardPlug(plugbase.Plug):
+    """Kicks and bans whoever floods or spams a channel.
+
+    Every channel message goes past a FloodDetector, which costs the same
+    however big the channel is.  Offenders are kicked; a host that gets
+    ban_after strikes within strike_window seconds is banned as well, for
+    ban_time seconds.  Kicks and bans are collected for action_delay
+    seconds and sent in as few lines as the server allows.  Nothing is done
+    in channels where the bot isn't opped, and ops, voiced users and users
+    with exempt_power are left alone.
+
+    guard_channels limits the plug to some channels; it watches every
+    channel it's in when that's empty.
+
+    Bans are lifted by saved timers, so they run out across restarts too.
+    One that comes due while the bot isn't opped, as it won't be right
+    after a restart, is tried again every unban_retry seconds, up to
+    unban_tries times.
+
+    """
+    name = 'FloodGuard'
+    hooks = [Event.chanmsg]
+    commands = ['floodguard']
+    # FloodGuard-specific options
+    guard_channels = []
+    window = 10
+    nick_limit = 8
+    host_limit = 12
+    repeat_window = 30
+    repeat_limit = 5
+    min_length = 10
+    max_tracked = 50000
+    strike_window = 3600
+    ban_after = 2
+    ban_time = 3600
+    action_delay = 1
+    exempt_power = 10
+    unban_retry = 60
+    unban_tries = 60
+
+    def load(self, startingup=True):
+        if self.guard_channels:
+            self.hooks = [(Event.chanmsg, {'channels': self.guard_channels})]
+        self.detector = detector.FloodDetector(window=self.window,
+            nick_limit=self.nick_limit, host_limit=self.host_limit,
+            repeat_window=self.repeat_window, repeat_limit=self.repeat_limit,
+            min_length=self.min_length, max_tracked=self.max_tracked)
+        self.strikes = detector.WindowCounter(self.strike_window, 6,
+                                              self.max_tracked)
+        # {channel: ({nickname: reason}, set([ban mask]))}
+        self.queued = {}
+        self.action = None
+        self.offences = 0
+        self.kicks = 0
+        self.bans = 0
+
+    def handle_chanmsg(self, source, target, msg, action):
+        user = self.users.by_nick(source)
+        if user is None:
+            return
+        reason = self.detector.check(self.users.fold(target), user.key,
+                                     user.hostmask, msg, time.time())
+        if reason is not None:
+            self.offend(target, user, reason)
+
+    def exempt(self, user, channel):
+        return (getattr(user, 'power', 0) >= self.exempt_power
+                or self.channels.is_op(user.nickname, channel)
+                or self.channels.is_voiced(user.nickname, channel))
+
+    def offend(self, channel, user, reason):
+        kicks, bans = self.queued.setdefault(channel, ({}, set()))
+        if user.nickname in kicks or self.exempt(user, channel):
+            return
+        self.offences += 1
+        self.log.info('%s is %s in %s' % (user.nickname, reason, channel))
+        kicks[user.nickname] = reason
+        strikes = self.strikes.hit(user.hostmask, time.time())
+        if strikes >= self.ban_after:
+            bans.add('*!*@%s' % (user.hostmask,))
+        if self.action is None:
+            self.action = self.schedule(self.action_delay, self.act)
+
+    def act(self):
+        """Send the kicks and bans collected since the last time."""
+        self.action = None
+        queued, self.queued = self.queued, {}
+        for channel, (kicks, bans) in queued.iteritems():
+            if not self.channels.is_op(self.core.nickname, channel):
+                self.log.warning('Not opped in %s, can\'t act on %s'
+                    % (channel, ', '.join(kicks)))
+                continue
+            bans = sorted(mask for mask in bans
+                          if not self.channels.is_banned(channel, mask))
+            if bans:
+                self.core.modes(channel, ['+b ' + mask for mask in bans])
+                self.bans += len(bans)
+                if self.ban_time:
+                    self.schedule_saved(self.ban_time, 'unban', channel,
+                                        bans)
+            by_reason = {}
+            for nickname, reason in kicks.iteritems():
+                by_reason.setdefault(reason, []).append(nickname)
+            for reason, nicknames in sorted(by_reason.iteritems()):
+                self.core.kick_many(channel, sorted(nicknames),
+                                    'Stop %s' % (reason,))
+                self.kicks += len(nicknames)
+
+    def unban(self, channel, masks, tries=0):
+        if not self.channels.is_op(self.core.nickname, channel):
+            if tries < self.unban_tries:
+                self.schedule_saved(self.unban_retry, 'unban', channel, masks,
+                                    tries + 1)
+            else:
+                self.log.warning('Not opped in %s, giving up on lifting %s'
+                    % (channel, ', '.join(masks)))
+            return
+        self.core.modes(channel, ['-b ' + mask for mask in masks
+            if self.channels.is_banned(channel, mask) is not False])
+
+    @plugbase.level(5)
+    def cmd_floodguard(self, source, target, argv):
+        """Show what the flood guard has been up to."""
+        self.respond(source, target,
+            '%d offences, %d kicks, %d bans; tracking %d nicks and %d hosts.'
+            % (self.offences, self.kicks, self.bans,
+               len(self.detector.nicks.keys), len(self.detector.hosts.keys)))
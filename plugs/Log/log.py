@@ -0,0 +1,314 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import bisect
+import errno
+import gzip
+import json
+import os
+import threading
+import time
+
+from twisted.internet import threads
+
+from plugs import plugbase
+from util import Event
+
+
+def segment_path(log_dir, channel, day):
+    """Path of the (uncompressed) log segment for channel on day."""
+    return os.path.join(log_dir, channel, day + '.log')
+
+
+def write_batch(log_dir, batch):
+    """Append a batch of lines to their segments.  Runs in a thread.
+
+    batch is {(channel, day): [(nick, line)]}.  Returns the offsets the last
+    line of each nick was written at, {channel: {nick: (day, offset)}}.
+
+    """
+    offsets = {}
+    for (channel, day), lines in batch.iteritems():
+        path = segment_path(log_dir, channel, day)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        chan_offsets = offsets.setdefault(channel, {})
+        with open(path, 'ab') as f:
+            position = f.tell()
+            data = []
+            for nick, line in lines:
+                line = line.encode('utf-8')
+                chan_offsets[nick] = (day, position)
+                position += len(line)
+                data.append(line)
+            f.write(''.join(data))
+    return offsets
+
+
+# Uncompressed bytes per gzip member of a compressed segment.
+BLOCK_SIZE = 64 * 1024
+# Seconds after which a compression lock is taken to be left by a crash.
+STALE_LOCK = 3600
+
+
+def lock_segment(path):
+    """Take the compression lock of a segment, returns whether we got it."""
+    lock = path + '.lock'
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    try:
+        if time.time() - os.path.getmtime(lock) < STALE_LOCK:
+            return False
+        os.utime(lock, None)
+    except OSError:
+        return False
+    return True
+
+
+def compress_segment(path):
+    """Gzip a closed segment and remove the original.  Runs in a thread.
+
+    The segment is compressed in independent gzip members of about
+    BLOCK_SIZE bytes, each ending on a line, and the uncompressed and
+    compressed offset of every member go to a .gz.idx file so read_line can
+    start at the right member.  A lock file keeps a reloaded plug from
+    compressing a segment that's still being compressed.
+
+    """
+    if not lock_segment(path):
+        return
+    blocks = []
+    with open(path, 'rb') as src:
+        with open(path + '.gz.tmp', 'wb') as raw:
+            position = 0
+            while True:
+                data = src.read(BLOCK_SIZE)
+                if not data:
+                    break
+                data += src.readline()
+                blocks.append((position, raw.tell()))
+                dst = gzip.GzipFile('', 'wb', fileobj=raw)
+                dst.write(data)
+                dst.close()
+                position += len(data)
+    with open(path + '.gz.idx', 'w') as f:
+        json.dump(blocks, f, separators=(',', ':'))
+    os.rename(path + '.gz.tmp', path + '.gz')
+    os.remove(path)
+    os.remove(path + '.lock')
+
+
+def read_line(path, offset):
+    """Read the line at offset from a segment, compressed or not."""
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            line = f.readline()
+    else:
+        try:
+            with open(path + '.gz.idx') as f:
+                blocks = json.load(f)
+        except (IOError, ValueError):
+            # Compressed as a single member, seeking means decompressing
+            # everything before the line.
+            blocks = [(0, 0)]
+        i = max(bisect.bisect_right([b[0] for b in blocks], offset) - 1, 0)
+        start, position = blocks[i]
+        with open(path + '.gz', 'rb') as raw:
+            raw.seek(position)
+            f = gzip.GzipFile(fileobj=raw, mode='rb')
+            f.seek(offset - start)
+            line = f.readline()
+    return line.decode('utf-8').rstrip('\n')
+
+
+class LogPlug(plugbase.Plug):
+    """Channel logging plug.
+
+    Lines are buffered in memory and written out in one batch every
+    flush_interval seconds, in a thread so the reactor never waits on the
+    disk.  The interval goes by the scheduler's tick, so lower the tick as
+    well for batches of less than a second.  Each channel gets a directory
+    in log_dir with a segment file per day; segments are gzipped in the
+    background once a day has passed since they were closed, so late lines
+    never race the compression.
+
+    For !last, the plug keeps the offset of the last line of each nick per
+    channel, and saves that index to index.json in the channel's directory
+    every index_interval seconds.
+
+    Writes to segments and to index files each go under a lock, so the
+    blocking writes in cleanup wait for a thread that's still at it instead
+    of interleaving with it.
+
+    """
+    name = 'Log'
+    hooks = [Event.chanmsg]
+    commands = ['last']
+    # Log-specific options
+    log_dir = 'logs'
+    flush_interval = 1
+    index_interval = 60
+
+    def load(self, startingup=True):
+        # {(folded channel, day): [(folded nick, line)]} waiting to be written
+        self.buffer = {}
+        # {folded channel: {folded nick: (day, offset)}}
+        self.index = {}
+        self.writing = False
+        self.write_lock = threading.Lock()
+        # The batch handed to a thread, until the thread gets to write it
+        self.unwritten = None
+        # Offsets of batches written in a thread, not yet in the index
+        self.landed = []
+        self.index_lock = threading.Lock()
+        # Each save of the index gets a number, so an older one that was
+        # slow to get a thread doesn't overwrite a newer one.
+        self.saves = 0
+        # {channel: number of the save on disk}
+        self.saved = {}
+        self.day = time.strftime('%Y-%m-%d')
+        if os.path.isdir(self.log_dir):
+            for channel in os.listdir(self.log_dir):
+                self.load_index(channel)
+        self.compress_old(self.day)
+        self.every(self.flush_interval, self.flush)
+        self.every(self.index_interval, self.save_index)
+
+    def cleanup(self):
+        if self.core is None:
+            # Already cleaned up: a !quit does, and then the lost
+            # connection does again.
+            return
+        # Blocking, but this is the last chance to get the lines out.  The
+        # lock waits for a batch that's still being written in a thread, and
+        # one the thread hasn't started on yet is written here, first.
+        with self.write_lock:
+            if self.unwritten is not None:
+                batch, self.unwritten = self.unwritten, None
+                self.landed.append(write_batch(self.log_dir, batch))
+            self.index_landed()
+            if self.buffer:
+                batch, self.buffer = self.buffer, {}
+                self.indexed(write_batch(self.log_dir, batch))
+        self.saves += 1
+        for channel, index in self.index.items():
+            self.write_index(channel, index, self.saves)
+        plugbase.Plug.cleanup(self)
+
+    def channel_dir(self, channel):
+        return self.users.fold(channel).replace(os.sep, '_')
+
+    def handle_chanmsg(self, source, target, msg, action):
+        if action:
+            line = '%s * %s %s\n' % (time.strftime('%H:%M:%S'), source, msg)
+        else:
+            line = '%s <%s> %s\n' % (time.strftime('%H:%M:%S'), source, msg)
+        key = (self.channel_dir(target), time.strftime('%Y-%m-%d'))
+        self.buffer.setdefault(key, []).append((self.users.fold(source), line))
+
+    def flush(self):
+        """Hand the buffered lines to a thread, one batch at a time."""
+        if self.writing or not self.buffer:
+            return
+        batch, self.buffer = self.buffer, {}
+        self.writing = True
+        self.unwritten = batch
+        d = threads.deferToThread(self.write, batch)
+        d.addCallback(lambda result: self.index_landed())
+        d.addErrback(lambda failure: self.log.error(
+            'Failed to write logs:\n%s' % (failure.getTraceback(),)))
+        d.addBoth(self.written)
+
+    def write(self, batch):
+        """Write a batch while holding the lock, unless cleanup already has.
+        Runs in a thread.
+
+        """
+        with self.write_lock:
+            if self.unwritten is batch:
+                self.unwritten = None
+                self.landed.append(write_batch(self.log_dir, batch))
+
+    def index_landed(self):
+        while self.landed:
+            self.indexed(self.landed.pop(0))
+
+    def written(self, result):
+        self.writing = False
+        today = time.strftime('%Y-%m-%d')
+        if today != self.day:
+            self.compress_old(self.day)
+            self.day = today
+
+    def indexed(self, offsets):
+        for channel, nicks in offsets.iteritems():
+            self.index.setdefault(channel, {}).update(nicks)
+
+    def compress_old(self, before):
+        """Gzip all segments from before the given day, in the background."""
+        if not os.path.isdir(self.log_dir):
+            return
+        for channel in os.listdir(self.log_dir):
+            path = os.path.join(self.log_dir, channel)
+            for segment in os.listdir(path):
+                if segment.endswith('.log') and segment[:-4] < before:
+                    segment = os.path.join(path, segment)
+                    d = threads.deferToThread(compress_segment, segment)
+                    d.addErrback(self.compress_failed, segment)
+
+    def compress_failed(self, failure, segment):
+        self.log.error('Failed to compress %s:\n%s'
+            % (segment, failure.getTraceback()))
+
+    def load_index(self, channel):
+        try:
+            with open(os.path.join(self.log_dir, channel, 'index.json')) as f:
+                self.index[channel] = dict((nick, tuple(entry))
+                    for nick, entry in json.load(f).iteritems())
+        except (IOError, ValueError):
+            self.log.info('No usable index for %s' % (channel,))
+
+    def write_index(self, channel, index, save):
+        """Write the index of a channel, unless a newer save got there
+        first.
+
+        """
+        path = os.path.join(self.log_dir, channel, 'index.json')
+        with self.index_lock:
+            if save <= self.saved.get(channel, 0):
+                return
+            with open(path + '.tmp', 'w') as f:
+                json.dump(index, f, separators=(',', ':'))
+            os.rename(path + '.tmp', path)
+            self.saved[channel] = save
+
+    def save_index(self):
+        self.saves += 1
+        for channel, index in self.index.items():
+            d = threads.deferToThread(self.write_index, channel, dict(index),
+                                      self.saves)
+            d.addErrback(lambda failure: self.log.error(
+                'Failed to save index:\n%s' % (failure.getTraceback(),)))
+
+    def cmd_last(self, source, target, argv):
+        """!last <nick> [#channel]: the last thing nick said in a channel."""
+        if len(argv) < 2:
+            return
+        channel = argv[2] if len(argv) > 2 else target
+        entry = self.index.get(self.channel_dir(channel), {}).get(
+            self.users.fold(argv[1]))
+        if entry is None:
+            self.respond(source, target, 'No record of %s in %s.'
+                % (argv[1], channel))
+            return
+        day, offset = entry
+        path = segment_path(self.log_dir, self.channel_dir(channel), day)
+        d = threads.deferToThread(read_line, path, offset)
+        d.addCallback(lambda line: self.respond(source, target,
+            '[%s %s] %s' % (channel, day, line)))
+        return d
@@ -0,0 +1,150 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import re
+import sqlite3
+import time
+
+from twisted.enterprise import adbapi
+
+from plugs import plugbase
+from util import Event
+
+
+# Seconds per unit for since:<n><unit>
+UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def create_tables(txn):
+    """Set up the schema, preferring FTS5 and falling back to FTS4."""
+    txn.execute('CREATE TABLE IF NOT EXISTS lines ('
+                'id INTEGER PRIMARY KEY, channel TEXT, nick TEXT, '
+                'time INTEGER, msg TEXT)')
+    txn.execute("SELECT name FROM sqlite_master WHERE name = 'lines_fts'")
+    if txn.fetchone():
+        return
+    try:
+        txn.execute('CREATE VIRTUAL TABLE lines_fts USING '
+                    'fts5(msg, content=lines, content_rowid=id)')
+    except sqlite3.OperationalError:
+        txn.execute('CREATE VIRTUAL TABLE lines_fts USING '
+                    'fts4(content="lines", msg)')
+
+
+def insert_batch(txn, rows):
+    """Store a batch of (channel, nick, time, msg) and index it."""
+    txn.execute('SELECT coalesce(max(id), 0) FROM lines')
+    last = txn.fetchone()[0]
+    txn.executemany('INSERT INTO lines (channel, nick, time, msg) '
+                    'VALUES (?, ?, ?, ?)', rows)
+    txn.execute('INSERT INTO lines_fts (rowid, msg) '
+                'SELECT id, msg FROM lines WHERE id > ?', (last,))
+
+
+class SearchPlug(plugbase.Plug):
+    """Full-text search over channel history.
+
+    Channel messages are collected in memory and added to an SQLite
+    full-text index in one transaction every index_interval seconds.  All
+    database work runs in adbapi's thread, so neither indexing nor !grep
+    ever blocks the reactor.
+
+    """
+    name = 'Search'
+    hooks = [Event.chanmsg]
+    commands = ['grep']
+    # Search-specific options
+    db_path = 'search.db'
+    index_interval = 1
+    page_size = 3
+
+    def load(self, startingup=True):
+        # A single connection: sqlite doesn't do concurrent writers anyway,
+        # and this keeps inserts and queries in order.
+        self.db = adbapi.ConnectionPool('sqlite3', self.db_path,
+            check_same_thread=False, cp_min=1, cp_max=1)
+        self.db.runInteraction(create_tables).addErrback(self.db_failed)
+        self.rows = []
+        self.every(self.index_interval, self.flush)
+
+    def cleanup(self):
+        if self.core is None:
+            # Already cleaned up: a !quit does, and then the lost
+            # connection does again.
+            return
+        self.flush()
+        self.db.close()
+        plugbase.Plug.cleanup(self)
+
+    def db_failed(self, failure):
+        self.log.error('Database error:\n%s' % (failure.getTraceback(),))
+
+    def handle_chanmsg(self, source, target, msg, action):
+        self.rows.append((self.users.fold(target), source, int(time.time()),
+                          msg))
+
+    def flush(self):
+        if self.rows:
+            rows, self.rows = self.rows, []
+            self.db.runInteraction(insert_batch, rows).addErrback(
+                self.db_failed)
+
+    def cmd_grep(self, source, target, argv):
+        """!grep [#channel] [nick:<nick>] [since:<n>m|h|d|w] [page:<n>] terms
+
+        Searches the current channel unless another one is given; in PM,
+        all channels.
+
+        """
+        channel = self.users.fold(target) if target.startswith('#') else None
+        nick = since = None
+        page = 1
+        terms = []
+        for arg in argv[1:]:
+            match = re.match(r'since:(\d+)([mhdw])$', arg)
+            if match:
+                since = int(time.time()) - \
+                    int(match.group(1)) * UNITS[match.group(2)]
+            elif arg.startswith('nick:'):
+                nick = arg[5:]
+            elif arg.startswith('page:') and arg[5:].isdigit():
+                page = max(1, int(arg[5:]))
+            elif arg.startswith('#'):
+                channel = self.users.fold(arg)
+            else:
+                # Quote every term so users can't inject query syntax.
+                terms.append('"%s"' % (arg.replace('"', '""'),))
+        if not terms:
+            self.respond(source, target, 'Usage: !grep [#channel] '
+                '[nick:<nick>] [since:<n>m|h|d|w] [page:<n>] terms')
+            return
+        query = ('SELECT l.channel, l.nick, l.time, l.msg FROM lines_fts '
+                 'JOIN lines l ON l.id = lines_fts.rowid '
+                 'WHERE lines_fts MATCH ?')
+        args = [' '.join(terms)]
+        if channel is not None:
+            query += ' AND l.channel = ?'
+            args.append(channel)
+        if nick is not None:
+            query += ' AND l.nick = ? COLLATE NOCASE'
+            args.append(nick)
+        if since is not None:
+            query += ' AND l.time >= ?'
+            args.append(since)
+        query += ' ORDER BY lines_fts.rowid DESC LIMIT ? OFFSET ?'
+        # One extra to see whether there's another page.
+        args += [self.page_size + 1, (page - 1) * self.page_size]
+        d = self.db.runQuery(query, args)
+        d.addCallback(self.reply, source, target, page)
+        return d
+
+    def reply(self, rows, source, target, page):
+        if not rows:
+            self.respond(source, target, 'No matches.')
+            return
+        for channel, nick, when, msg in rows[:self.page_size]:
+            self.respond(source, target, '[%s %s] <%s> %s' % (channel,
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(when)),
+                nick, msg))
+        if len(rows) > self.page_size:
+            self.respond(source, target, 'More with page:%d' % (page + 1,))
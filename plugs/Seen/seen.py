@@ -0,0 +1,203 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import sqlite3
+import time
+from collections import OrderedDict
+
+from twisted.internet import threads
+
+from plugs import plugbase
+from util import Event
+
+
+def read_snapshot(path, limit):
+    """Load the limit most recent entries, oldest first.
+
+    Returns [(key, nickname, userhost, when, action, channel, text)].
+
+    """
+    db = sqlite3.connect(path)
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS seen ('
+                   'key TEXT PRIMARY KEY, nickname TEXT, userhost TEXT, '
+                   'time REAL, action TEXT, channel TEXT, text TEXT)')
+        rows = db.execute('SELECT * FROM seen ORDER BY time DESC LIMIT ?',
+                          (limit,)).fetchall()
+        if len(rows) == limit:
+            # max_entries went down since the last run.
+            db.execute('DELETE FROM seen WHERE time < ?', (rows[-1][3],))
+            db.commit()
+    finally:
+        db.close()
+    rows.reverse()
+    return rows
+
+
+def write_snapshot(path, rows, evicted):
+    """Store changed entries and drop evicted ones.  Runs in a thread."""
+    db = sqlite3.connect(path)
+    try:
+        with db:
+            db.executemany('INSERT OR REPLACE INTO seen VALUES '
+                           '(?, ?, ?, ?, ?, ?, ?)', rows)
+            db.executemany('DELETE FROM seen WHERE key = ?',
+                           [(key,) for key in evicted])
+    finally:
+        db.close()
+
+
+def ago(seconds):
+    """Roughly how long ago, like '3d 4h' or '12m 5s'."""
+    seconds = int(seconds)
+    parts = []
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        if seconds >= size or (unit == 's' and not parts):
+            parts.append('%d%s' % (seconds // size, unit))
+            seconds %= size
+        if len(parts) == 2:
+            break
+    return ' '.join(parts)
+
+
+class SeenPlug(plugbase.Plug):
+    """Remembers when and where each nick was last seen.
+
+    The records live in an OrderedDict kept in order of activity, so once
+    there are max_entries of them the nick that has been quiet the longest
+    is dropped and memory stays bounded no matter how busy the channels
+    are.  Every snapshot_interval seconds the records that changed since the
+    last snapshot are written to SQLite in a thread; at startup the most
+    recent max_entries are read back in one query.
+
+    """
+    name = 'Seen'
+    hooks = [Event.chanmsg, Event.userleft, Event.userquit,
+             Event.userrenamed]
+    # Event.userjoined also fires for everyone who's already in a channel
+    # when the bot joins it, so joins come from the raw JOIN lines.
+    rawhooks = ['JOIN']
+    commands = ['seen']
+    # Missing a line now and then under a flood doesn't matter much here.
+    lossy = True
+    # Seen-specific options
+    db_path = 'seen.db'
+    max_entries = 100000
+    max_text = 200
+    snapshot_interval = 300
+
+    def load(self, startingup=True):
+        # {folded nick: (nickname, userhost, time, action, channel, text)}
+        self.entries = OrderedDict()
+        for row in read_snapshot(self.db_path, self.max_entries):
+            self.entries[row[0]] = row[1:]
+        self.log.info('Loaded %d entries' % (len(self.entries),))
+        # Keys changed and keys evicted since the last snapshot
+        self.dirty = set()
+        self.evicted = set()
+        self.saving = False
+        self.every(self.snapshot_interval, self.snapshot)
+
+    def cleanup(self):
+        # Blocking, but this is the last chance to get them out.
+        rows, evicted = self.take_changes()
+        if rows or evicted:
+            write_snapshot(self.db_path, rows, evicted)
+        plugbase.Plug.cleanup(self)
+
+    def record(self, nickname, action, channel='', text=''):
+        key = self.users.fold(nickname)
+        user = self.users.by_nick(nickname)
+        if user is not None:
+            userhost = '%s@%s' % (user.username, user.hostmask)
+        elif key in self.entries:
+            userhost = self.entries[key][1]
+        else:
+            userhost = ''
+        # Re-inserting moves the key to the most recent end.
+        self.entries.pop(key, None)
+        self.entries[key] = (nickname, userhost, time.time(), action, channel,
+                             text[:self.max_text])
+        self.dirty.add(key)
+        self.evicted.discard(key)
+        while len(self.entries) > self.max_entries:
+            old, entry = self.entries.popitem(last=False)
+            self.dirty.discard(old)
+            self.evicted.add(old)
+
+    def handle_chanmsg(self, source, target, msg, action):
+        if action:
+            msg = '* %s %s' % (source, msg)
+        self.record(source, 'msg', target, msg)
+
+    def raw_JOIN(self, command, prefix, params):
+        nickname = prefix.split('!', 1)[0]
+        if self.users.fold(nickname) != self.users.fold(self.core.nickname):
+            self.record(nickname, 'join', params[0])
+
+    def handle_userleft(self, nickname, channel):
+        self.record(nickname, 'part', channel)
+
+    def handle_userquit(self, nickname, message):
+        self.record(nickname, 'quit', text=message)
+
+    def handle_userrenamed(self, oldname, newname):
+        self.record(oldname, 'nick', text=newname)
+        self.record(newname, 'renamed', text=oldname)
+
+    def take_changes(self):
+        rows = [(key,) + self.entries[key] for key in self.dirty]
+        evicted = list(self.evicted)
+        self.dirty = set()
+        self.evicted = set()
+        return rows, evicted
+
+    def snapshot(self):
+        """Hand everything that changed to a thread, one batch at a time."""
+        if self.saving or not (self.dirty or self.evicted):
+            return
+        rows, evicted = self.take_changes()
+        self.saving = True
+        d = threads.deferToThread(write_snapshot, self.db_path, rows, evicted)
+        d.addErrback(self.snapshot_failed, rows, evicted)
+        d.addBoth(self.saved)
+
+    def snapshot_failed(self, failure, rows, evicted):
+        self.log.error('Failed to save snapshot:\n%s'
+            % (failure.getTraceback(),))
+        # Try again with the next one, unless they've changed since.
+        for row in rows:
+            if row[0] in self.entries:
+                self.dirty.add(row[0])
+        self.evicted.update(key for key in evicted
+                            if key not in self.entries)
+
+    def saved(self, result):
+        self.saving = False
+
+    def cmd_seen(self, source, target, argv):
+        """!seen <nick>: when and where nick was last seen."""
+        if len(argv) < 2:
+            self.respond(source, target, 'Usage: !seen <nick>')
+            return
+        entry = self.entries.get(self.users.fold(argv[1]))
+        if entry is None:
+            self.respond(source, target, 'I haven\'t seen %s.' % (argv[1],))
+            return
+        nickname, userhost, when, action, channel, text = entry
+        if action == 'msg':
+            what = 'in %s, saying: %s' % (channel, text)
+        elif action == 'join':
+            what = 'joining %s' % (channel,)
+        elif action == 'part':
+            what = 'leaving %s' % (channel,)
+        elif action == 'quit':
+            what = 'quitting (%s)' % (text,)
+        elif action == 'nick':
+            what = 'changing nick to %s' % (text,)
+        else:
+            what = 'changing nick from %s' % (text,)
+        if userhost:
+            nickname = '%s (%s)' % (nickname, userhost)
+        self.respond(source, target, '%s was last seen %s ago, %s'
+            % (nickname, ago(time.time() - when), what))
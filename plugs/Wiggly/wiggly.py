@@ -214,12 +214,15 @@ in processing.'
             raise
         finally:
             # Whether it worked or not, send feedback to ops
+            operators = []
             for op_uid in self.signups[uid]['approvals']:
                 operator = self.users.by_uid(op_uid)
                 if operator:
                     # is the operator still online?
-                    user = self.users.by_uid(uid).nickname
-                    self.core.notice(operator.nickname, message % (user,))
+                    operators.append(operator.nickname)
+            if operators:
+                user = self.users.by_uid(uid).nickname
+                self.core.notice_many(operators, message % (user,))
             del self.signups[uid]
 
     def process_results(self, uid, results):
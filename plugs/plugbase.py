@@ -4,6 +4,7 @@
 """Plugin base for Shirk."""
 
 import json
+import re
 from functools import wraps
 
 
@@ -19,21 +20,64 @@ def level(level):
         def newf(self, nickname, *args):
             user = self.users.by_nick(nickname)
             if user and user.power >= level:
-                f(self, nickname, *args)
+                return f(self, nickname, *args)
         return newf
     return decorator
 
 
+def cached(f):
+    """Decorator for !commands whose reply only changes with the plugs.
+
+    The decorated cmd_foo(self, source, target, argv) returns its reply
+    instead of sending it.  Replies are remembered per set of arguments until
+    the core's generation changes, which it does whenever plugs or commands
+    are added or removed.  Goes below @level if both are used.
+
+    """
+    @wraps(f)
+    def newf(self, source, target, argv):
+        if self.response_generation != self.core.generation:
+            self.response_cache.clear()
+            self.response_generation = self.core.generation
+        key = (f.__name__, tuple(argv[1:]))
+        if key in self.response_cache:
+            response = self.response_cache[key]
+        else:
+            response = f(self, source, target, argv)
+            if len(self.response_cache) >= 100:
+                self.response_cache.clear()
+            self.response_cache[key] = response
+        if response:
+            self.respond(source, target, response)
+    return newf
+
+
 class Plug(object):
     """Base class for Shirk plugs.
 
     Specifies some utility functions and glue between core and plug.
 
+    Handlers may return a Deferred, for instance by being written as
+    defer.inlineCallbacks generators that yield the result of
+    self.core.whois(), self.core.who() or self.ask().  Those are cancelled
+    when the plug is unloaded.
+
     """
     name = "Plug"
     commands = []
+    # Events to be called for, or (event, filters) to only be called for
+    # some of them, like (Event.chanmsg, {'channels': ['#help']}); see
+    # subscriptions.py for the filters.
     hooks = []
     rawhooks = []
+    # Keywords (strings) and compiled regexes to look for in channel
+    # messages, see handle_trigger.
+    triggers = []
+    # False for stand-ins that haven't imported the actual plug yet.
+    loaded = True
+    # Whether the plug can do without some chanmsg events when the bot is
+    # overloaded, see inbound.py.
+    lossy = False
 
     def __init__(self, core, startingup=True):
         """Create a new Plug instance.  
@@ -50,6 +94,11 @@ class Plug(object):
         self.log.info("Loading")
         self.core = core
         self.users = core.users
+        self.channels = core.channels
+        self.pending = set()
+        self.timers = set()
+        self.response_cache = {}
+        self.response_generation = None
         self.load_config()
         self.load(startingup)
 
@@ -79,9 +128,15 @@ class Plug(object):
         for cmd in self.commands:
             self.core.add_command(cmd, self)
         for event in self.hooks:
-            self.core.add_callback(event, self)
+            if isinstance(event, basestring):
+                self.core.add_callback(event, self)
+            else:
+                event, filters = event
+                self.core.add_callback(event, self, **filters)
         for cmd in self.rawhooks:
             self.core.add_raw(cmd, self)
+        for trigger in self.triggers:
+            self.core.add_trigger(trigger, self)
 
     def cleanup(self):
         """Clean up any potential circular references etc.
@@ -90,8 +145,58 @@ class Plug(object):
 
         """
         self.log.info("Cleanup")
+        for timer in list(self.timers):
+            timer.cancel()
+        for d in list(self.pending):
+            d.cancel()
         self.core = None
 
+    def schedule(self, delay, fn, *args):
+        """Call fn(*args) in delay seconds, give or take a second.
+
+        Returns a scheduler.Timer that can be cancelled; it's cancelled
+        anyway when the plug is unloaded.  If fn returns a Deferred, that's
+        tracked like the plug's other Deferreds.
+
+        """
+        return self.core.scheduler.call_later(delay, fn, args, self)
+
+    def every(self, interval, fn, *args):
+        """Call fn(*args) every interval seconds, starting in interval."""
+        return self.core.scheduler.call_later(interval, fn, args, self,
+                                              interval=interval)
+
+    def schedule_saved(self, delay, method, *args):
+        """Call self.method(*args) in delay seconds, even after a restart.
+
+        The call is written to disk, so args must be JSON serializable and
+        come back as lists and unicode strings.  It's made on whichever
+        instance of this plug is loaded at the time, and dropped if none is.
+        Cancelling the returned Timer removes it from disk as well.
+
+        """
+        return self.core.scheduler.save(delay, self.name, method, args)
+
+    def forget_timer(self, timer):
+        self.timers.discard(timer)
+
+    def track(self, d):
+        """Cancel the Deferred d if it hasn't fired when the plug unloads."""
+        self.pending.add(d)
+        def untrack(result):
+            self.pending.discard(d)
+            return result
+        return d.addBoth(untrack)
+
+    def ask(self, nickname, question, timeout=300):
+        """Ask nickname something in PM.
+
+        Returns a Deferred that fires with their next private message, or
+        fails with defer.TimeoutError if there's no answer in time.
+
+        """
+        return self.track(self.core.ask(nickname, question, timeout))
+
     def respond(self, source, target, msg):
         """Figures out where a reply should be sent to and sends it.
 
@@ -126,7 +231,17 @@ doesn\'t override it.')
 
         """
         callback = getattr(self, 'cmd_' + argv[0], self.unhandled_cmd)
-        callback(source, target, argv)
+        return callback(source, target, argv)
+
+    def handle_trigger(self, source, target, msg, trigger, match):
+        """Called when a channel message sets off one of self.triggers.
+
+        trigger is the keyword or regex from self.triggers, match is the
+        regex's match object or None for keywords.
+
+        """
+        self.log.warning('handle_trigger has been triggered, but the plug \
+doesn\'t override it.')
 
     def handle_private(self, source, msg, action):
         """Called when the bot receives a private message"""
@@ -138,6 +253,31 @@ doesn\'t override it.')
         self.log.warning('handle_userjoined has been triggered, but the plug \
 doesn\'t override it.')
 
+    def handle_userleft(self, nickname, channel):
+        """Called when a user has parted or been kicked from a channel."""
+        self.log.warning('handle_userleft has been triggered, but the plug \
+doesn\'t override it.')
+
+    def handle_userquit(self, nickname, message):
+        """Called when a user has quit IRC."""
+        self.log.warning('handle_userquit has been triggered, but the plug \
+doesn\'t override it.')
+
+    def handle_userrenamed(self, oldname, newname):
+        """Called when a user has changed nick."""
+        self.log.warning('handle_userrenamed has been triggered, but the \
+plug doesn\'t override it.')
+
+    def handle_netsplit(self, servers, users):
+        """Called with all users lost in a netsplit at once."""
+        self.log.warning('handle_netsplit has been triggered, but the plug \
+doesn\'t override it.')
+
+    def handle_netjoin(self, servers, users):
+        """Called with all users that came back from a netsplit at once."""
+        self.log.warning('handle_netjoin has been triggered, but the plug \
+doesn\'t override it.')
+
     def handle_usercreated(self, user):
         """Called when a new user is added to the Users instance."""
         self.log.warning('handle_usercreated has been triggered, but the \
@@ -148,6 +288,16 @@ plug doesn\'t override it.')
         self.log.warning('handle_userremoved has been triggered, but the \
 plug doesn\'t override it.')
 
+    def handle_useraccount(self, user):
+        """Called when a user logs in to or out of an account."""
+        self.log.warning('handle_useraccount has been triggered, but the \
+plug doesn\'t override it.')
+
+    def handle_casemapping(self):
+        """Called when the server's casemapping has changed."""
+        self.log.warning('handle_casemapping has been triggered, but the \
+plug doesn\'t override it.')
+
     def handle_raw(self, command, prefix, params):
         """Called for the raw hooks.
 
@@ -156,7 +306,7 @@ plug doesn\'t override it.')
 
         """
         callback = getattr(self, 'raw_' + command, self.unhandled_raw)
-        callback(command, prefix, params)
+        return callback(command, prefix, params)
 
     def unhandled_cmd(self, source, target, argv):
         """Called for unhandled !commands.
@@ -177,3 +327,78 @@ plug doesn\'t override it.')
         """
         self.log.warning('Received unhandled raw: %s %s %r'
             % (prefix, command, params))
+
+
+def _wake_and_forward(method):
+    """Build a PlugStub handler that loads the real plug and passes it on."""
+    def forward(self, *args):
+        plug = self.core.wake_plug(self.name)
+        if plug is not None:
+            return getattr(plug, method)(*args)
+    forward.__name__ = method
+    return forward
+
+
+class PlugStub(Plug):
+    """Stand-in for a plug that hasn't been imported yet.
+
+    Registers the commands and hooks listed in the plug's manifest and has
+    the core load the real plug as soon as one of them fires, after which the
+    event is passed on and the stub is discarded.
+
+    """
+    loaded = False
+
+    def __init__(self, core, name, manifest):
+        self.name = name
+        self.log = core.log.getChild(name)
+        self.core = core
+        self.users = core.users
+        self.channels = core.channels
+        self.pending = set()
+        self.commands = manifest.get('commands', [])
+        self.hooks = manifest.get('hooks', [])
+        self.rawhooks = manifest.get('rawhooks', [])
+        self.lossy = manifest.get('lossy', False)
+        self.triggers = manifest.get('triggers', []) + [re.compile(pattern)
+            for pattern in manifest.get('regex_triggers', [])]
+        self.woken = None
+
+    def cleanup(self):
+        self.core = None
+
+    def handle_trigger(self, source, target, msg, trigger, match):
+        # A message can set off several triggers, the stub is gone by the
+        # second one.
+        if self.woken is None:
+            self.woken = self.core.wake_plug(self.name)
+        plug = self.woken
+        if plug is None:
+            return
+        if not isinstance(trigger, basestring):
+            # Hand the plug its own regex rather than the stub's copy.
+            for own in plug.triggers:
+                if getattr(own, 'pattern', None) == trigger.pattern:
+                    trigger = own
+                    break
+        return plug.handle_trigger(source, target, msg, trigger, match)
+
+    handle_addressed = _wake_and_forward('handle_addressed')
+    handle_chanmsg = _wake_and_forward('handle_chanmsg')
+    handle_command = _wake_and_forward('handle_command')
+    handle_private = _wake_and_forward('handle_private')
+    handle_userjoined = _wake_and_forward('handle_userjoined')
+    handle_userleft = _wake_and_forward('handle_userleft')
+    handle_userquit = _wake_and_forward('handle_userquit')
+    handle_userrenamed = _wake_and_forward('handle_userrenamed')
+    handle_netsplit = _wake_and_forward('handle_netsplit')
+    handle_netjoin = _wake_and_forward('handle_netjoin')
+    handle_usercreated = _wake_and_forward('handle_usercreated')
+    handle_userremoved = _wake_and_forward('handle_userremoved')
+    handle_useraccount = _wake_and_forward('handle_useraccount')
+
+    def handle_casemapping(self):
+        # Nothing to refold yet, the real plug folds with the new
+        # casemapping when it loads.
+        pass
+    handle_raw = _wake_and_forward('handle_raw')
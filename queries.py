@@ -0,0 +1,159 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Bookkeeping for the queries Shirk sends to the server.
+
+WHOIS, WHO, NAMES and MODE replies are numerics that don't say who asked for
+them.  QueryMux keeps track of the outstanding requests, sends a limited
+number of them at a time and hands each reply line to the request it belongs
+to instead of to every plug with a raw hook.
+
+"""
+
+import logging
+
+from twisted.internet import defer, reactor
+
+
+# kind: (line to send, numerics that make up the reply, numerics that end it)
+QUERIES = {
+    'WHOIS': ('WHOIS %s', ['311', '312', '313', '317', '319', '330'],
+              ['318']),
+    'WHO': ('WHO %s', ['352'], ['315']),
+    'NAMES': ('NAMES %s', ['353'], ['366']),
+    'MODE': ('MODE %s', [], ['324', '403', '442']),
+    'BANS': ('MODE %s +b', ['367'], ['368', '403', '442', '482']),
+}
+
+# ERR_NOSUCHNICK answers anything sent to a nick that isn't there, not just
+# WHOIS, so it only goes to a WHOIS for the nick it names.
+NOSUCHNICK = '401'
+
+
+class Query(object):
+    """A single request and everyone waiting for its reply.
+
+    lines collects (numeric, params) for every reply line, end marker
+    included.
+
+    """
+    def __init__(self, kind, target, key):
+        self.kind = kind
+        self.target = target
+        self.key = key
+        self.lines = []
+        self.waiters = []
+        self.expiry = None
+
+
+class QueryMux(object):
+    """Pipelines queries and routes their replies.
+
+    core: the Shirk instance, used to send lines and fold names.
+    max_inflight: how many queries may be waiting for a reply at once; the
+        rest are queued so a burst of them doesn't get us flooded off.
+    timeout: seconds after which an unanswered query is given up on.
+
+    """
+    def __init__(self, core, max_inflight=4, timeout=60):
+        self.log = logging.getLogger('Queries')
+        self.core = core
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        # {(kind, folded target): Query} for everything sent or queued
+        self.queries = {}
+        self.queue = []
+        self.inflight = 0
+        self.routes = {}
+        for kind, (line, replies, ends) in QUERIES.iteritems():
+            for numeric in replies + ends:
+                self.routes.setdefault(numeric, []).append(kind)
+
+    def request(self, kind, target, timeout=30):
+        """Ask the server something, see QUERIES for the kinds.
+
+        Returns a Deferred that fires with Query.lines, or fails
+        with defer.TimeoutError.  Identical requests share a single query.
+
+        """
+        key = (kind, self.core.users.fold(target))
+        query = self.queries.get(key)
+        if query is None:
+            query = self.queries[key] = Query(kind, target, key)
+            self.queue.append(query)
+            self.send_queued()
+        def cancel(d):
+            query.waiters.remove(d)
+            if not query.waiters and query in self.queue:
+                self.queue.remove(query)
+                del self.queries[key]
+        d = defer.Deferred(cancel)
+        query.waiters.append(d)
+        return d.addTimeout(timeout, reactor)
+
+    def send_queued(self):
+        while self.queue and self.inflight < self.max_inflight:
+            query = self.queue.pop(0)
+            self.inflight += 1
+            query.expiry = reactor.callLater(self.timeout, self.expire, query)
+            self.core.sendLine(QUERIES[query.kind][0] % (query.target,))
+
+    def feed(self, command, params):
+        """Route a reply line to its query.
+
+        Returns True if the line was consumed, in which case it shouldn't be
+        passed on to anyone else.
+
+        """
+        if len(params) < 3:
+            return False
+        if command == NOSUCHNICK:
+            key = ('WHOIS', self.core.users.fold(params[1]))
+            query = self.queries.get(key)
+            if query is None or query.expiry is None:
+                return False
+            query.lines.append((command, params))
+            return True
+        if command not in self.routes:
+            return False
+        target = params[2] if command == '353' else params[1]
+        for kind in self.routes[command]:
+            key = (kind, self.core.users.fold(target))
+            query = self.queries.get(key)
+            if query is not None and query.expiry is not None:
+                query.lines.append((command, params))
+                if command in QUERIES[kind][2]:
+                    self.finish(query)
+                return True
+        return False
+
+    def finish(self, query):
+        query.expiry.cancel()
+        self.done(query)
+        # A waiter's callback may cancel another waiter of the same query.
+        for d in list(query.waiters):
+            if not d.called:
+                d.callback(query.lines)
+
+    def expire(self, query):
+        self.log.warning('No reply to %s %s' % (query.kind, query.target))
+        self.done(query)
+        for d in list(query.waiters):
+            if not d.called:
+                d.errback(defer.TimeoutError())
+
+    def done(self, query):
+        del self.queries[query.key]
+        self.inflight -= 1
+        self.send_queued()
+
+    def cancel_all(self):
+        """Cancel everything, for when the connection's gone."""
+        for query in self.queries.values():
+            if query.expiry is not None and query.expiry.active():
+                query.expiry.cancel()
+            for d in list(query.waiters):
+                d.cancel()
+        self.queries = {}
+        self.queue = []
+        self.inflight = 0
@@ -0,0 +1,126 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Rate limiting of the commands and private messages users send Shirk.
+
+Every reply to a !command ends up in the same outgoing queue, so a handful
+of users repeating cheap commands can get the bot flooded off the server.
+RateLimiter keeps a token bucket per host and per channel and tells the core
+to drop whatever doesn't fit before any plug gets to see it.
+
+"""
+
+import time
+from collections import OrderedDict
+
+
+class TokenBucket(object):
+    """Holds up to burst tokens, refilled at rate tokens per second."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, cost, now):
+        """Take cost tokens if there are enough; returns whether it did."""
+        self.refill(now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter(object):
+    """Per-host and per-channel command budgets.
+
+    user_rate, user_burst: tokens per second and bucket size for each host.
+    channel_rate, channel_burst: the same for each channel.
+    costs: {command: cost} for commands that are more expensive than 1.
+    repeat_window: an identical command line in the same channel within
+        this many seconds is dropped, the reply to the first one is still
+        on screen.
+    max_buckets: the most buckets kept per kind, and the most command
+        lines remembered for the repeat check, so memory stays bounded.
+        The least recently used ones are thrown away first.
+    exempt_power: users with at least this power aren't limited at all.
+
+    """
+    def __init__(self, user_rate=0.5, user_burst=5, channel_rate=1,
+                 channel_burst=10, costs=None, repeat_window=10,
+                 max_buckets=10000, exempt_power=10):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.costs = costs or {}
+        self.repeat_window = repeat_window
+        self.max_buckets = max_buckets
+        self.exempt_power = exempt_power
+        # Least recently used first
+        self.hosts = OrderedDict()
+        self.channels = OrderedDict()
+        # {(channel, line): time} for the repeat check, oldest first
+        self.recent = OrderedDict()
+        self.shed = 0
+
+    def bucket(self, buckets, key, rate, burst, now):
+        bucket = buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst, now)
+            while len(buckets) >= self.max_buckets:
+                buckets.popitem(last=False)
+        buckets[key] = bucket
+        return bucket
+
+    def allow_private(self, host):
+        """A private message from host; returns False to drop it."""
+        now = time.time()
+        bucket = self.bucket(self.hosts, host, self.user_rate,
+                             self.user_burst, now)
+        if bucket.take(1, now):
+            return True
+        self.shed += 1
+        return False
+
+    def allow_command(self, host, channel, line):
+        """A command line (without prefix) from host in channel.
+
+        channel is None for commands sent in PM.  Returns False to drop it.
+
+        """
+        now = time.time()
+        if channel is not None:
+            last = self.recent.get((channel, line))
+            if last is not None and now - last < self.repeat_window:
+                self.shed += 1
+                return False
+        cost = self.costs.get(line.split(None, 1)[0], 1)
+        user = self.bucket(self.hosts, host, self.user_rate,
+                           self.user_burst, now)
+        if channel is not None:
+            chan = self.bucket(self.channels, channel, self.channel_rate,
+                               self.channel_burst, now)
+            chan.refill(now)
+            if chan.tokens < cost:
+                self.shed += 1
+                return False
+        if not user.take(cost, now):
+            self.shed += 1
+            return False
+        if channel is not None:
+            chan.tokens -= cost
+            self.recent.pop((channel, line), None)
+            recent = self.recent
+            while recent and (len(recent) >= self.max_buckets or
+                    now - next(recent.itervalues()) >= self.repeat_window):
+                recent.popitem(last=False)
+            self.recent[(channel, line)] = now
+        return True
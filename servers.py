@@ -0,0 +1,173 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""The servers Shirk can connect to, and how well they've been doing.
+
+ServerPool resolves every server's name ahead of time, in a thread since
+getaddrinfo blocks, and keeps the addresses for resolve_ttl seconds.  Each
+server has a health record, shared by all its addresses and ports: a server
+that fails is skipped for a while, twice as long after every consecutive
+failure, and among healthy servers the one that connected quickest is
+tried first.
+
+"""
+
+import logging
+import socket
+import time
+
+from twisted.internet import defer, task, threads
+
+
+class Health(object):
+    """The track record of a server."""
+
+    def __init__(self):
+        self.failures = 0
+        self.down_until = 0
+        # Smoothed seconds to establish a connection
+        self.connect_time = None
+
+
+class Server(object):
+    """One host:port.
+
+    health is shared with every other Server for the same host.
+
+    """
+    def __init__(self, host, port, health):
+        self.host = host
+        self.port = port
+        self.health = health
+        # Resolved addresses, alternating between IPv6 and IPv4
+        self.addresses = []
+        self.resolved = None
+
+    def __str__(self):
+        return '%s:%d' % (self.host, self.port)
+
+    def healthy(self, now):
+        return now >= self.health.down_until
+
+
+def interleave(infos):
+    """Order getaddrinfo results IPv6, IPv4, IPv6... as happy eyeballs does."""
+    families = {}
+    for family, socktype, proto, canonname, sockaddr in infos:
+        addresses = families.setdefault(family, [])
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    v6 = families.get(socket.AF_INET6, [])
+    v4 = families.get(socket.AF_INET, [])
+    ordered = []
+    for i in xrange(max(len(v6), len(v4))):
+        ordered.extend(v6[i:i + 1] + v4[i:i + 1])
+    return ordered
+
+
+class ServerPool(object):
+    """Picks where to connect to.
+
+    servers: a list of 'host:port' strings.
+    resolve_ttl: seconds to trust resolved addresses for.
+    race: how many addresses to try to connect to at once.
+    stagger: seconds between starting those attempts.
+    connect_timeout: seconds after which a connection attempt is given up.
+    max_penalty: the longest a failing server is skipped for, in seconds.
+
+    """
+    def __init__(self, servers, resolve_ttl=300, race=2, stagger=0.25,
+                 connect_timeout=10, max_penalty=300):
+        self.log = logging.getLogger('Servers')
+        self.servers = []
+        # {host: Health}
+        self.health = {}
+        for server in servers:
+            host, _, port = server.rpartition(':')
+            self.servers.append(Server(host, int(port),
+                                       self.health.setdefault(host, Health())))
+        self.resolve_ttl = resolve_ttl
+        self.race = race
+        self.stagger = stagger
+        self.connect_timeout = connect_timeout
+        self.max_penalty = max_penalty
+        self.resolver = None
+
+    def start(self):
+        """Resolve everything now and again whenever it goes stale."""
+        if self.resolver is None:
+            self.resolver = task.LoopingCall(self.refresh)
+            self.resolver.start(self.resolve_ttl)
+
+    def stop(self):
+        if self.resolver is not None:
+            self.resolver.stop()
+            self.resolver = None
+
+    def refresh(self):
+        now = time.time()
+        return defer.DeferredList([self.resolve(server)
+            for server in self.servers
+            if server.resolved is None
+            or now - server.resolved >= self.resolve_ttl])
+
+    def resolve(self, server):
+        d = threads.deferToThread(socket.getaddrinfo, server.host,
+                                  server.port, 0, socket.SOCK_STREAM)
+        d.addCallback(self.resolved, server)
+        d.addErrback(self.resolve_failed, server)
+        return d
+
+    def resolved(self, infos, server):
+        server.addresses = interleave(infos)
+        server.resolved = time.time()
+        self.log.debug('%s is at %s' % (server, ', '.join(server.addresses)))
+
+    def resolve_failed(self, failure, server):
+        # Old addresses beat no addresses, so keep whatever we had.
+        self.log.warning('Could not resolve %s: %s'
+            % (server.host, failure.getErrorMessage()))
+
+    def ranked(self):
+        """Servers, healthy ones first and quickest first among those."""
+        now = time.time()
+        return sorted(self.servers, key=lambda server: (
+            not server.healthy(now), server.health.failures,
+            server.health.connect_time
+            if server.health.connect_time is not None else 1))
+
+    def candidates(self):
+        """The (server, address) pairs to race this time around.
+
+        Servers whose name hasn't been resolved yet are tried by name.
+
+        """
+        candidates = []
+        for server in self.ranked():
+            for address in server.addresses or [server.host]:
+                candidates.append((server, address))
+                if len(candidates) == max(1, self.race):
+                    return candidates
+        return candidates
+
+    def any_healthy(self):
+        now = time.time()
+        return any(server.healthy(now) for server in self.servers)
+
+    def failed(self, server):
+        """None of server's addresses worked out this time."""
+        health = server.health
+        health.failures += 1
+        penalty = min(self.max_penalty, 2 ** (health.failures - 1))
+        health.down_until = time.time() + penalty
+        self.log.info('%s failed %d times in a row, skipping it for %ds'
+            % (server.host, health.failures, penalty))
+
+    def succeeded(self, server, connect_time):
+        health = server.health
+        health.failures = 0
+        health.down_until = 0
+        if health.connect_time is None:
+            health.connect_time = connect_time
+        else:
+            health.connect_time += 0.25 * (connect_time - health.connect_time)
@@ -6,18 +6,56 @@
 """Shirk: an easily extensible IRC bot based on Twisted."""
 
 # Standard library imports
+import base64
 import importlib
 import json
 import logging
+import sys
+import time
 
 # Twisted imports
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol
+from twisted.internet import defer, reactor, protocol
 
 # Project imports
 from util import Event
+from plugs import plugbase
+import batching
+import channels
+import inbound
+import lag
+import queries
+import ratelimit
+import scheduler
+import servers
+import subscriptions
+import tls
+import triggers
 import users
 
+# IRCv3 message tag escapes, the character after the backslash mapped to
+# what it stands for.
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def unescape_tag(value):
+    """Undo the escaping of an IRCv3 message tag value.
+
+    Unknown escapes stand for the escaped character itself and a lone
+    backslash at the end is dropped.
+
+    """
+    if '\\' not in value:
+        return value
+    out = []
+    chars = iter(value)
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '')
+            char = TAG_ESCAPES.get(char, char)
+        out.append(char)
+    return ''.join(out)
+
 
 class Shirk(irc.IRCClient):
     """A simple modular IRC bot.
@@ -38,20 +76,91 @@ class Shirk(irc.IRCClient):
     # List of events that don't need any other information in the hook,
     # unlike .command and .raw which need other params specified.
     _simple_events = [Event.addressed, Event.chanmsg, Event.private,
-        Event.userjoined, Event.usercreated, Event.userremoved]
+        Event.userjoined, Event.usercreated, Event.userremoved,
+        Event.useraccount, Event.userleft, Event.userquit,
+        Event.userrenamed, Event.netsplit, Event.netjoin,
+        Event.casemapping]
 
     def load_plugs(self):
-        """Load the plugs listed in config."""
+        """Load the plugs listed in config.
+
+        If config['lazy_plugs'] is set, plugs that ship a manifest are only
+        stubbed in; see stub_plug.
+
+        """
         self.plugs = {}
         self.hooks = {Event.raw:        {},  # dictionary of
                       Event.command:    {}}  # 'command': set([plug, plug])
         for ev in self._simple_events:
             self.hooks[ev] = set()
+        self.subscriptions = subscriptions.Subscriptions(self)
+        self.triggers = triggers.TriggerRegistry()
+        self.scheduler = scheduler.Scheduler(self, **self.config['scheduler'])
         for plugname in self.config['plugs']:
+            manifest = None
+            if self.config['lazy_plugs']:
+                manifest = self.read_manifest(plugname)
             try:
-                self.load_plug(plugname)
+                if manifest is None:
+                    self.load_plug(plugname)
+                else:
+                    self.stub_plug(plugname, manifest)
             except ImportError:
                 self.log.exception('Failed to load plug %s.', plugname)
+        # Saved timers may wake stubbed plugs, so only now that they're all
+        # there.
+        self.scheduler.restore()
+        self.log.info('Loaded plugs: %s; deferred: %s' % (
+            ', '.join(n for n, p in self.plugs.iteritems() if p.loaded),
+            ', '.join(n for n, p in self.plugs.iteritems() if not p.loaded)))
+
+    def read_manifest(self, plugname):
+        """Read plugs/{plugname}/manifest.json, or return None.
+
+        A manifest lists the commands, hooks and rawhooks of a plug, which is
+        all the core needs to know to route events to it before the plug's
+        module has been imported.  Keyword triggers go under triggers, and
+        the patterns of regex triggers under regex_triggers.  Filtered hooks
+        are [event, {filters}] pairs, as in Plug.hooks.
+
+        """
+        manifestfile = 'plugs/%s/manifest.json' % (plugname,)
+        try:
+            with open(manifestfile) as f:
+                return json.load(f)
+        except IOError:
+            return None
+        except ValueError:
+            self.log.exception('Ignoring broken manifest %s.', manifestfile)
+            return None
+
+    def stub_plug(self, plugname, manifest):
+        """Register a stand-in for the plug identified by plugname.
+
+        The stub takes the plug's place in the dispatch tables and loads the
+        real plug the first time any of its events fire.
+
+        """
+        plug = plugbase.PlugStub(self, plugname, manifest)
+        self.plugs[plugname] = plug
+        plug.hook_events()
+
+    def wake_plug(self, plugname):
+        """Replace a plug stub with the real plug and return the latter.
+
+        If the plug fails to load, the stub stays where it is and None is
+        returned.
+
+        """
+        stub = self.plugs[plugname]
+        try:
+            self.load_plug(plugname)
+        except ImportError:
+            self.log.exception('Failed to lazily load plug %s.', plugname)
+            return None
+        self._unhook(stub)
+        self.log.info('Lazily loaded plug %s.', plugname)
+        return self.plugs[plugname]
 
     def load_plug(self, plugname):
         """Load the plug identified by plugname.
@@ -66,6 +175,7 @@ class Shirk(irc.IRCClient):
         plug = module.Plug(self, self.startingup)
         self.plugs[plugname] = plug
         plug.hook_events()
+        self.generation += 1
 
     def remove_plug(self, plugname):
         """Remove the plug identified by plugname.
@@ -74,7 +184,11 @@ class Shirk(irc.IRCClient):
         KeyError if the plug wasn't in self.plugs.
 
         """
-        plug = self.plugs[plugname]
+        plug = self.plugs.pop(plugname)
+        self._unhook(plug)
+
+    def _unhook(self, plug):
+        """Clean up plug and take it out of all events."""
         plug.cleanup()
         for cmd, callbacks in self.hooks[Event.command].iteritems():
             callbacks.discard(plug)
@@ -82,7 +196,9 @@ class Shirk(irc.IRCClient):
             callbacks.discard(plug)
         for ev in self._simple_events:
             self.hooks[ev].discard(plug)
-        del self.plugs[plugname]
+        self.subscriptions.remove_plug(plug)
+        self.triggers.remove_plug(plug)
+        self.generation += 1
 
     def shutdown(self, msg):
         """Shutdown, as it says on the tin.
@@ -106,6 +222,21 @@ class Shirk(irc.IRCClient):
         line = line.encode('utf-8')
         irc.IRCClient.sendLine(self, line)
 
+    def send_now(self, line):
+        """Send a line right away, skipping the flood protection queue."""
+        self._reallySendLine(line.encode('utf-8'))
+
+    def handshake_done(self):
+        """The first line arrived, so any TLS handshake is over."""
+        self.handshaken = True
+        if self.attempt is not None and self.attempt.tls is not None:
+            self.attempt.handshaken = time.time()
+            self.attempt.tls.handshake_done()
+
+    def _sendHeartbeat(self):
+        """Twisted's keepalive PING, which doubles as lag measurement."""
+        self.lag.ping()
+
     ## Twisted's callbacks
     # Things the bot does
 
@@ -119,15 +250,95 @@ class Shirk(irc.IRCClient):
         self.log.info('Connected to server')
         # Connected successfully, so reset the reconn delay
         self.factory.resetDelay()
-        self.users = users.Users(self)
+        self.users = users.Users(self, self.config['split_timeout'])
+        self.channels = channels.Channels(self)
         self.nickname = self.config['nickname']
         self.password = self.config['password']
         self.cmd_prefix = self.config['cmd_prefix']
         self.realname = self.config['realname']
         self.username = self.config['username']
         self.startingup = True
+        # Bumped whenever the set of plugs or commands changes, which
+        # invalidates the responses of plugbase.cached commands.
+        self.generation = 0
+        # IRCv3 capabilities the server acknowledged, the ones it offers
+        # while CAP LS is still coming in, and the tags of the current line.
+        self.caps = set()
+        self._caps_offered = set()
+        self.tags = {}
+        self.queries = queries.QueryMux(self, self.config['query_pipeline'])
+        self.inbound = inbound.Inbound(self, **self.config['inbound'])
+        self.ratelimit = ratelimit.RateLimiter(**self.config['rate_limit'])
+        self.lag = lag.LagMeter(self, **self.config['lag'])
+        if self.factory.line_rate is not None:
+            self.lag.rate = self.factory.line_rate
+        self.heartbeatInterval = self.lag.interval
+        # Outstanding questions, {folded nick: (None, [Deferred])}
+        self._asks = {}
+        # The attempt that won the race to connect, with its timings.  Its
+        # TLS handshake is certainly done once the first line comes in.
+        self.attempt = self.factory.winner
+        self.handshaken = False
+        # None, 'started' or 'done'
+        self._sasl = None
+        self._sasl_timeout = None
         irc.IRCClient.connectionMade(self)
 
+    def register(self, nickname, hostname='foo', servername='bar'):
+        """Start capability negotiation before registering.
+
+        Servers without CAP support just ignore the CAP LS, servers with it
+        hold registration until we send CAP END.
+
+        """
+        self.sendLine('CAP LS 302')
+        irc.IRCClient.register(self, nickname, hostname, servername)
+
+    def start_sasl(self):
+        """Authenticate with SASL before registration completes."""
+        self._sasl = 'started'
+        self._sasl_timeout = reactor.callLater(15, self.sasl_done, False,
+                                               'no reply')
+        self.sendLine('AUTHENTICATE %s'
+            % (self.config['sasl']['mechanism'].upper(),))
+
+    def sasl_done(self, success, message):
+        if self._sasl != 'started':
+            return
+        self._sasl = 'done'
+        if self._sasl_timeout.active():
+            self._sasl_timeout.cancel()
+        if success:
+            self.log.info('SASL authentication succeeded')
+        else:
+            self.log.warning('SASL authentication failed: %s' % (message,))
+        if not self._registered:
+            self.end_cap_negotiation()
+
+    def irc_AUTHENTICATE(self, prefix, params):
+        """The server is ready for (more of) our SASL credentials."""
+        if params[0] != '+' or self._sasl != 'started':
+            return
+        sasl = self.config['sasl']
+        if sasl['mechanism'].upper() == 'EXTERNAL':
+            # The client certificate is all the server needs.
+            self.sendLine('AUTHENTICATE +')
+            return
+        payload = base64.b64encode('\0'.join([sasl['username'],
+            sasl['username'], sasl['password']]).encode('utf-8'))
+        # At most 400 bytes per line, and an empty line if the last one was
+        # exactly that long.
+        for i in xrange(0, len(payload), 400):
+            self.sendLine('AUTHENTICATE %s' % (payload[i:i + 400],))
+        if len(payload) % 400 == 0:
+            self.sendLine('AUTHENTICATE +')
+
+    def end_cap_negotiation(self):
+        """Finish capability negotiation and let registration complete."""
+        self.log.info('Enabled capabilities: %s'
+            % (', '.join(sorted(self.caps)) or 'none',))
+        self.sendLine('CAP END')
+
     def connectionLost(self, reason):
         """Called when the connection is shut down.
 
@@ -139,9 +350,21 @@ class Shirk(irc.IRCClient):
 
         """
         self.log.info('Connection lost: %s' % (reason,))
+        self.queries.cancel_all()
+        self.inbound.stop()
+        self.lag.stop()
+        if self._sasl_timeout is not None and self._sasl_timeout.active():
+            self._sasl_timeout.cancel()
+        # Start the next connection at the pace this one ended with.
+        self.factory.line_rate = self.lag.rate
+        for result, waiters in self._asks.values():
+            for d in list(waiters):
+                d.cancel()
         try:
             for name, plug in self.plugs.iteritems():
                 plug.cleanup()
+            self.scheduler.stop()
+            self.users.cancel_splits()
             del self.users
         except AttributeError:
             # this happens when the bot is shutdown before having connected
@@ -152,47 +375,178 @@ class Shirk(irc.IRCClient):
     def signedOn(self):
         """Called when bot has succesfully signed on to server."""
         self.log.info('Signed on')
+        if self.attempt is not None:
+            now = time.time()
+            timings = 'TCP %.3fs' % (self.attempt.connected
+                                     - self.attempt.started,)
+            if self.attempt.handshaken is not None:
+                timings += ', TLS %.3fs%s' % (self.attempt.handshaken
+                    - self.attempt.connected,
+                    ' (resumed)' if self.attempt.tls.resumed else '')
+            self.log.info('Ready %.3fs after starting to connect (%s)'
+                % (now - self.attempt.started, timings))
         self.load_plugs()
         for chan in self.config['channels']:
             self.join(chan)
-        self.lineRate = 0.3
+        self.lineRate = self.lag.rate
+        self.lag.ping()
         self.startingup = False
 
+    def isupport(self, options):
+        """The server told us about the features it supports (005)."""
+        for option in options:
+            if option.startswith('CASEMAPPING='):
+                self.set_casemapping(option.split('=', 1)[1])
+
+    def set_casemapping(self, casemapping):
+        """Switch to the server's casemapping and refold everything that was
+        keyed on the old one.
+
+        Folding isn't reversible, so the channel names as the server spelled
+        them are collected before the switch.
+
+        """
+        names = dict((key, chan.name) for key, chan
+                     in self.channels.channels.iteritems())
+        self.users.set_casemapping(casemapping, names)
+        self.channels.refold()
+        self.subscriptions.stale = True
+        self.event_casemapping()
+
+    def modes(self, channel, changes):
+        """Make several mode changes on channel in as few lines as possible.
+
+        changes are strings like '+o nick', '-v nick', '+b *!*@host' or '+m'.
+        As many go on a line as the server's MODES allows.
+
+        """
+        always, when_set = batching.param_modes(self.supported)
+        for line in batching.mode_lines(channel, changes,
+                self.supported.getFeature('MODES'), always, when_set,
+                self._safeMaximumLineLength('')):
+            self.sendLine(line)
+
+    def msg_many(self, targets, message):
+        """Send the same message to several targets, several to a line."""
+        self._send_many('PRIVMSG', targets, message)
+
+    def notice_many(self, targets, message):
+        """Send the same notice to several targets, several to a line."""
+        self._send_many('NOTICE', targets, message)
+
+    def kick_many(self, channel, nicknames, reason):
+        """Kick several users from channel, several to a line."""
+        for line in batching.target_lines('KICK %s' % (channel,), nicknames,
+                reason, batching.max_targets(self.supported, 'KICK'),
+                self._safeMaximumLineLength('')):
+            self.sendLine(line)
+
+    def _send_many(self, command, targets, message):
+        for line in batching.target_lines(command, targets, message,
+                batching.max_targets(self.supported, command),
+                self._safeMaximumLineLength('')):
+            self.sendLine(line)
+
     def joined(self, channel):
-        """Called when I finish joining a channel."""
-        self.sendLine('WHO %s' % (channel,))
+        """Called when I finish joining a channel.
+
+        With userhost-in-names the NAMES reply that follows the join has
+        everything Users needs, otherwise fall back to WHO.
+
+        """
+        self.channels.joined(channel)
+        # Users and Channels are filled from the replies, nothing to do with
+        # the results.
+        ignore = lambda failure: failure.trap(defer.CancelledError,
+                                              defer.TimeoutError)
+        if 'userhost-in-names' not in self.caps:
+            self.who(channel).addErrback(ignore)
+        self.queries.request('MODE', channel).addErrback(ignore)
+        self.queries.request('BANS', channel).addErrback(ignore)
+
+    def left(self, channel):
+        self.channels.left(channel)
+
+    def kickedFrom(self, channel, kicker, message):
+        self.log.warning('Kicked from %s by %s: %s'
+            % (channel, kicker, message))
+        self.channels.left(channel)
+
+    def nickChanged(self, nick):
+        self.channels.user_renamed(self.nickname, nick)
+        irc.IRCClient.nickChanged(self, nick)
+
+    def modeChanged(self, user, channel, set, modes, args):
+        if channel != self.nickname:
+            self.channels.mode_changed(channel, set, modes, args)
+
+    def topicUpdated(self, user, channel, newTopic):
+        self.channels.topic_changed(channel, newTopic)
 
     # Things other users do
 
-    def userJoined(self, user, channel):
+    def userJoined(self, user, channel, account=None):
         nickname, rest = user.split('!', 1)
         username, hostmask = rest.split('@', 1)
-        self.users.user_joined(nickname, username, hostmask, channel)
+        self.users.user_joined(nickname, username, hostmask, channel,
+                               account)
+        self.channels.user_joined(nickname, channel)
         self.event_userjoined(nickname, channel)
 
     def userLeft(self, user, channel):
+        self.event_userleft(user, channel)
         self.users.user_left(user, channel)
+        self.channels.user_left(user, channel)
 
     def userKicked(self, kickee, channel, kicker, message):
+        self.event_userleft(kickee, channel)
         self.users.user_left(kickee, channel)
+        self.channels.user_left(kickee, channel)
 
     def userQuit(self, user, quitMessage):
-        self.users.user_quit(user)
+        self.event_userquit(user, quitMessage)
+        self.users.user_quit(user, quitMessage)
+        self.channels.user_quit(user)
 
     def userRenamed(self, oldname, newname):
+        self.event_userrenamed(oldname, newname)
         self.users.user_nickchange(oldname, newname)
+        self.channels.user_renamed(oldname, newname)
 
     def privmsg(self, user, target, msg):
-        """The bot receives a PRIVMSG, either in channel or in PM"""
-        user = user.split('!', 1)[0]
+        """The bot receives a PRIVMSG, either in channel or in PM
+
+        Commands and private messages have to get past the rate limiter
+        first; what doesn't is dropped before any plug sees it.
+
+        """
+        user, _, host = user.partition('!')
+        host = host.partition('@')[2]
         msg = msg.strip()
         self.log.debug('%s: <%s> %s' % (target, user, msg))
+        private = target == self.nickname
+        command = msg.startswith(self.cmd_prefix) and len(msg) > 1
+        allowed = True
+        if (command or private) and not self.is_exempt(user):
+            if command:
+                channel = None if private else self.users.fold(target)
+                allowed = self.ratelimit.allow_command(host, channel,
+                    msg[len(self.cmd_prefix):])
+            else:
+                allowed = self.ratelimit.allow_private(host)
+            if not allowed:
+                self.log.debug('Rate limited %s (%d dropped so far)'
+                    % (user, self.ratelimit.shed))
         # Check to see if they're sending me a private message
-        if target == self.nickname:
+        if private:
+            if not allowed:
+                return
             self.event_private(user, msg, False)
         else:
             self.event_chanmsg(user, target, msg, False)
-        if msg.startswith(self.cmd_prefix) and len(msg) > 1:
+            if not command:
+                self.check_triggers(user, host, target, msg)
+        if command and allowed:
             argv = msg[len(self.cmd_prefix):].split()
             self.event_command(user, target, argv)
         elif msg.startswith(self.nickname):
@@ -200,27 +554,173 @@ class Shirk(irc.IRCClient):
             message = msg[len(self.nickname) + 1:].strip()
             self.event_addressed(user, target, message)
 
+    def is_exempt(self, nickname):
+        """Whether nickname has enough power to skip rate limiting."""
+        user = self.users.by_nick(nickname)
+        return getattr(user, 'power', 0) >= self.ratelimit.exempt_power
+
+    def check_triggers(self, user, host, target, msg):
+        """Run a channel message past the triggers plugs registered.
+
+        A message that sets off any trigger is likely to get a reply, so it
+        counts against the rate limiter the way a command does.
+
+        """
+        matches = self.triggers.match(msg)
+        if not matches:
+            return
+        if not self.is_exempt(user) and not self.ratelimit.allow_command(
+                host, self.users.fold(target), msg):
+            self.log.debug('Rate limited %s (%d dropped so far)'
+                % (user, self.ratelimit.shed))
+            return
+        self.event_trigger(user, target, msg, matches)
+
     def action(self, user, target, msg):
         """The bot sees someone perform a CTCP ACTION, or "/me"."""
-        user = user.split('!', 1)[0]
+        user, _, host = user.partition('!')
+        host = host.partition('@')[2]
         msg = msg.strip()
         self.log.debug('%s: * %s %s' % (target, user, msg))
         # Check to see if they're sending me a private message
         if target == self.nickname:
+            if not self.is_exempt(user) and \
+                    not self.ratelimit.allow_private(host):
+                self.log.debug('Rate limited %s (%d dropped so far)'
+                    % (user, self.ratelimit.shed))
+                return
             self.event_private(user, msg, True)
         else:
             self.event_chanmsg(user, target, msg, True)
+            self.check_triggers(user, host, target, msg)
 
     # Lower-level callbacks
 
     def irc_JOIN(self, prefix, params):
-        """Called when a user joins a channel."""
+        """Called when a user joins a channel.
+
+        With extended-join the params are channel, account and realname.
+
+        """
         nick = prefix.split('!', 1)[0]
-        channel = params[-1]
+        channel = params[0]
+        account = None
+        if 'extended-join' in self.caps and len(params) > 1:
+            account = params[1]
         if nick == self.nickname:
             self.joined(channel)
         else:
-            self.userJoined(prefix, channel)
+            self.userJoined(prefix, channel, account)
+
+    def irc_PONG(self, prefix, params):
+        self.lag.pong(params[-1])
+
+    def irc_ERROR(self, prefix, params):
+        """The server is closing the connection, and says why."""
+        self.log.warning('Server error: %s' % (params[-1],))
+        if 'flood' in params[-1].lower():
+            self.lag.flooding(params[-1])
+
+    def irc_RPL_TRYAGAIN(self, prefix, params):
+        """263: the server dropped a command because it's too busy."""
+        self.lag.flooding(params[-1])
+
+    def irc_unknown(self, prefix, command, params):
+        if command == '439':
+            # ERR_TARGETTOOFAST, messaging too many targets too quickly
+            self.lag.flooding(params[-1])
+        elif command == '900':
+            # RPL_LOGGEDIN
+            self.log.info('Logged in as %s' % (params[2],))
+        elif command == '903':
+            # RPL_SASLSUCCESS
+            self.sasl_done(True, params[-1])
+        elif command in ('902', '904', '905', '906', '908'):
+            # Locked account, failure, too long, aborted, unknown mechanism
+            self.sasl_done(False, params[-1])
+
+    def irc_CAP(self, prefix, params):
+        """Capability negotiation, see http://ircv3.net/specs/core/.
+
+        params[1] is the subcommand; a multiline LS has a '*' before the
+        last param.
+
+        """
+        subcmd = params[1]
+        offered = set(cap.split('=', 1)[0] for cap in params[-1].split())
+        if subcmd == 'LS':
+            self._caps_offered.update(offered)
+            if len(params) > 3 and params[2] == '*':
+                return
+            wanted = self._caps_offered & set(self.config['caps'])
+            if self.config['sasl'] and 'sasl' in self._caps_offered:
+                wanted.add('sasl')
+            if wanted and not self._registered:
+                self.sendLine('CAP REQ :%s' % (' '.join(sorted(wanted)),))
+            else:
+                self.end_cap_negotiation()
+        elif subcmd == 'ACK':
+            for cap in offered:
+                if cap.startswith('-'):
+                    self.caps.discard(cap[1:])
+                else:
+                    self.caps.add(cap)
+            if self._registered:
+                return
+            if 'sasl' in self.caps and self._sasl is None:
+                self.start_sasl()
+            elif self._sasl != 'started':
+                self.end_cap_negotiation()
+        elif subcmd == 'NAK':
+            self.log.warning('Server refused capabilities: %s'
+                % (params[-1],))
+            if not self._registered:
+                self.end_cap_negotiation()
+        elif subcmd == 'DEL':
+            self.caps.difference_update(offered)
+
+    def irc_ACCOUNT(self, prefix, params):
+        """account-notify: a user logged in to or out of an account."""
+        self.users.user_account(prefix.split('!', 1)[0], params[0])
+
+    def irc_AWAY(self, prefix, params):
+        """away-notify: a user went away or came back."""
+        self.users.user_away(prefix.split('!', 1)[0],
+                             params[0] if params else None)
+
+    def irc_RPL_NAMREPLY(self, prefix, params):
+        """Received a NAMES reply.
+
+        Gives Channels everyone's status.  With userhost-in-names each entry
+        is a nick!user@host with any status prefixes in front of it, which
+        is enough for Users as well.
+
+        """
+        channel = params[2]
+        self.channels.names(channel, params[3].split())
+        if 'userhost-in-names' not in self.caps:
+            return
+        statuses = ''.join(status for status, priority
+            in self.supported.getFeature('PREFIX', {}).itervalues())
+        for entry in params[3].split():
+            entry = entry.lstrip(statuses)
+            if '!' not in entry:
+                continue
+            nickname, rest = entry.split('!', 1)
+            if nickname == self.nickname:
+                continue
+            username, hostmask = rest.split('@', 1)
+            self.users.user_joined(nickname, username, hostmask, channel)
+            self.event_userjoined(nickname, channel)
+
+    def irc_RPL_CHANNELMODEIS(self, prefix, params):
+        self.channels.channel_modes(params[1], params[2], params[3:])
+
+    def irc_RPL_BANLIST(self, prefix, params):
+        self.channels.ban_listed(params[1], params[2])
+
+    def irc_RPL_ENDOFBANLIST(self, prefix, params):
+        self.channels.ban_list_end(params[1])
 
     def irc_RPL_WHOREPLY(self, prefix, params):
         """Received a reply to a vanilla WHO command"""
@@ -231,18 +731,35 @@ class Shirk(irc.IRCClient):
         self.event_userjoined(params[5], params[1])
 
     def lineReceived(self, line):
+        """Parse a line and leave it to Inbound to decide when it's handled."""
+        if not self.handshaken:
+            self.handshake_done()
         line = irc.lowDequote(line).decode(self.config['charset'], 'replace')
+        tags = {}
+        if line.startswith('@'):
+            # IRCv3 message tags, kept around for whoever wants them.
+            rawtags, line = line[1:].split(' ', 1)
+            for tag in rawtags.split(';'):
+                key, _, value = tag.partition('=')
+                tags[key] = unescape_tag(value)
         try:
             prefix, command, params = irc.parsemsg(line)
-            if command in irc.numeric_to_symbolic:
-                parsedcmd = irc.numeric_to_symbolic[command]
-            else:
-                parsedcmd = command
-            self.handleCommand(parsedcmd, prefix, params)
-            if self._registered:
-                self.event_raw(command, prefix, params)
         except irc.IRCBadMessage:
             self.badMessage(line, *sys.exc_info())
+            return
+        self.inbound.received(tags, prefix, command, params)
+
+    def handle_line(self, tags, prefix, command, params):
+        """Handle a parsed line, possibly a while after it came in."""
+        self.tags = tags
+        if command in irc.numeric_to_symbolic:
+            parsedcmd = irc.numeric_to_symbolic[command]
+        else:
+            parsedcmd = command
+        self.handleCommand(parsedcmd, prefix, params)
+        # Replies to our own queries only go to whoever asked.
+        if self._registered and not self.queries.feed(command, params):
+            self.event_raw(command, prefix, params)
 
     ## Shirk's events that modules can register callbacks for
 
@@ -255,8 +772,8 @@ class Shirk(irc.IRCClient):
         msg: The actual message.
 
         """
-        for plug in self.hooks[Event.addressed]:
-            plug.handle_addressed(source, target, msg)
+        for plug in self._subscribers(Event.addressed, target, source, msg):
+            self._handled(plug, plug.handle_addressed(source, target, msg))
 
     def event_chanmsg(self, source, channel, msg, action):
         """The bot is sent a message in a channel.
@@ -266,9 +783,12 @@ class Shirk(irc.IRCClient):
         msg: The actual message.
         action: A bool indicating whether this was a CTCP ACTION ('/me')
 
+        Plugs that set lossy miss these while the inbound queue is too long.
+
         """
-        for plug in self.hooks[Event.chanmsg]:
-            plug.handle_chanmsg(source, channel, msg, action)
+        plugs = self._subscribers(Event.chanmsg, channel, source, msg)
+        for plug in self.inbound.shed(plugs):
+            self._handled(plug, plug.handle_chanmsg(source, channel, msg, action))
 
     def event_command(self, source, target, argv):
         """The bot receives a !command.
@@ -283,7 +803,18 @@ class Shirk(irc.IRCClient):
             # raises an error "Set changed size during iteration"
             to_call = set(self.hooks[Event.command][argv[0]])
             for plug in to_call:
-                plug.handle_command(source, target, argv)
+                self._handled(plug, plug.handle_command(source, target, argv))
+
+    def event_trigger(self, source, target, msg, matches):
+        """A channel message set off one or more triggers.
+
+        matches: [(plug, trigger, match)] as returned by
+            TriggerRegistry.match.
+
+        """
+        for plug, trigger, match in matches:
+            self._handled(plug, plug.handle_trigger(source, target, msg,
+                                                    trigger, match))
 
     def event_private(self, source, msg, action):
         """The bot is sent a message in PM.
@@ -293,8 +824,13 @@ class Shirk(irc.IRCClient):
         action: A bool indicating whether this was a CTCP ACTION ('/me')
 
         """
-        for plug in self.hooks[Event.private]:
-            plug.handle_private(source, msg, action)
+        key = self.users.fold(source)
+        if key in self._asks:
+            # Someone's waiting for this answer, see ask().
+            self._resolve(self._asks, key, msg)
+            return
+        for plug in self._subscribers(Event.private, None, source, msg):
+            self._handled(plug, plug.handle_private(source, msg, action))
 
     def event_raw(self, command, prefix, params):
         """Pretty much any message triggers this event.
@@ -310,7 +846,7 @@ class Shirk(irc.IRCClient):
         if command in self.hooks[Event.raw]:
             to_call = set(self.hooks[Event.raw][command])
             for plug in to_call:
-                plug.handle_raw(command, prefix, params)
+                self._handled(plug, plug.handle_raw(command, prefix, params))
 
     def event_userjoined(self, nickname, channel):
         """A user has joined a channel, or the bot joined a channel.
@@ -319,8 +855,50 @@ class Shirk(irc.IRCClient):
         channel that the bot just joined.
 
         """
-        for plug in self.hooks[Event.userjoined]:
-            plug.handle_userjoined(nickname, channel)
+        for plug in self._subscribers(Event.userjoined, channel, nickname):
+            self._handled(plug, plug.handle_userjoined(nickname, channel))
+
+    def event_userleft(self, nickname, channel):
+        """A user has left a channel, by parting or being kicked.
+
+        Fired before Users forgets about the channel, so the user can still
+        be looked up.
+
+        """
+        for plug in self._subscribers(Event.userleft, channel, nickname):
+            self._handled(plug, plug.handle_userleft(nickname, channel))
+
+    def event_userquit(self, nickname, message):
+        """A user has quit IRC.  Fired before Users removes them."""
+        for plug in self._subscribers(Event.userquit, None, nickname):
+            self._handled(plug, plug.handle_userquit(nickname, message))
+
+    def event_userrenamed(self, oldname, newname):
+        """A user has changed nick.  Fired before Users renames them."""
+        for plug in self._subscribers(Event.userrenamed, None, oldname):
+            self._handled(plug, plug.handle_userrenamed(oldname, newname))
+
+    def event_netsplit(self, servers, users):
+        """Users were lost in a netsplit.
+
+        servers: The quit message, usually the names of the two servers.
+        users: The User objects, which are kept until the users come back or
+            split_timeout runs out.  No userremoved is fired for them until
+            then.
+
+        """
+        for plug in set(self.hooks[Event.netsplit]):
+            self._handled(plug, plug.handle_netsplit(servers, users))
+
+    def event_netjoin(self, servers, users):
+        """Users came back from a netsplit.
+
+        The User objects are the ones they had before the split, so no
+        usercreated is fired for them.
+
+        """
+        for plug in set(self.hooks[Event.netjoin]):
+            self._handled(plug, plug.handle_netjoin(servers, users))
 
     def event_usercreated(self, user):
         """A new user has been introduced to user management.
@@ -329,8 +907,8 @@ class Shirk(irc.IRCClient):
         User instance.
 
         """
-        for plug in self.hooks[Event.usercreated]:
-            plug.handle_usercreated(user)
+        for plug in set(self.hooks[Event.usercreated]):
+            self._handled(plug, plug.handle_usercreated(user))
 
     def event_userremoved(self, user):
         """A user has left the building.
@@ -340,11 +918,144 @@ class Shirk(irc.IRCClient):
         with the bot.
 
         """
-        for plug in self.hooks[Event.userremoved]:
-            plug.handle_userremoved(user)
+        for plug in set(self.hooks[Event.userremoved]):
+            self._handled(plug, plug.handle_userremoved(user))
+
+    def event_useraccount(self, user):
+        """A user logged in to or out of their account.
+
+        Only triggered by account-notify; user.account holds the new account
+        name or '*' when they logged out.
+
+        """
+        for plug in set(self.hooks[Event.useraccount]):
+            self._handled(plug, plug.handle_useraccount(user))
+
+    def event_casemapping(self):
+        """The server's CASEMAPPING came in and users and channels have been
+        refolded, so plugs can refold whatever they keep themselves.
+
+        """
+        for plug in set(self.hooks[Event.casemapping]):
+            self._handled(plug, plug.handle_casemapping())
+
+    def _subscribers(self, event, channel=None, nickname=None, msg=None):
+        """The plugs to call for an event: those that hooked it without
+        filters and those whose filters let it through.
+
+        """
+        plugs = set(self.hooks[event])
+        plugs.update(self.subscriptions.select(event, channel, nickname, msg))
+        return plugs
+
+    def _handled(self, plug, result):
+        """Keep an eye on handlers that returned a Deferred.
+
+        Any handler may return a Deferred, typically by being decorated with
+        defer.inlineCallbacks.  It's cancelled if the plug is unloaded before
+        it finishes, and failures are logged.
+
+        """
+        if isinstance(result, defer.Deferred):
+            if not plug.loaded:
+                # A stub that just woke up; the Deferred came from the real
+                # plug, which has taken its place.
+                plug = self.plugs.get(plug.name, plug)
+            plug.track(result).addErrback(self._handler_failed, plug)
+
+    def _handler_failed(self, failure, plug):
+        if not failure.check(defer.CancelledError):
+            self.log.error('Unhandled error in plug %s:\n%s'
+                % (plug.name, failure.getTraceback()))
+
+    def _parse_whois(self, lines):
+        """Turn the reply lines of a WHOIS into the dict whois() promises."""
+        result = dict.fromkeys(['nickname', 'username', 'hostmask',
+            'realname', 'server', 'account'])
+        result['channels'] = []
+        for command, params in lines:
+            if command == '311':
+                result.update(nickname=params[1], username=params[2],
+                    hostmask=params[3], realname=params[5])
+            elif command == '312':
+                result['server'] = params[2]
+            elif command == '319':
+                result['channels'].extend(params[2].split())
+            elif command == '330':
+                result['account'] = params[2]
+        if result['username'] is None:
+            # There was a 401 instead of a 311: no such nick.
+            return None
+        return result
+
+    def _wait(self, pending, key, timeout):
+        """Return a Deferred that fires when pending[key] is resolved.
+
+        It fails with defer.TimeoutError after timeout seconds.
+
+        """
+        result, waiters = pending[key]
+        def cancel(d):
+            waiters.remove(d)
+            if not waiters and pending.get(key, (None, None))[1] is waiters:
+                del pending[key]
+        d = defer.Deferred(cancel)
+        waiters.append(d)
+        return d.addTimeout(timeout, reactor)
+
+    def _resolve(self, pending, key, result):
+        """Fire everything waiting for pending[key] with result."""
+        for d in pending.pop(key)[1]:
+            d.callback(result)
 
     ## Things modules will want to use
 
+    def whois(self, nickname, timeout=30):
+        """Send a WHOIS for nickname and return a Deferred for the reply.
+
+        The result is a dict with the keys nickname, username, hostmask,
+        realname, server, account and channels, or None if there's no such
+        nick.  Fields the server didn't send are None.  Concurrent calls
+        for the same nick share a single WHOIS.
+
+        """
+        return self.queries.request('WHOIS', nickname, timeout).addCallback(
+            self._parse_whois)
+
+    def who(self, channel, timeout=30):
+        """Send a WHO for channel and return a Deferred for the reply.
+
+        The result is a list of dicts with the keys nickname, username,
+        hostmask, flags and realname.
+
+        """
+        return self.queries.request('WHO', channel, timeout).addCallback(
+            lambda lines: [{'nickname': params[5], 'username': params[2],
+                'hostmask': params[3], 'flags': params[6],
+                'realname': params[7].split(' ', 1)[-1]}
+                for command, params in lines if command == '352'])
+
+    def names(self, channel, timeout=30):
+        """Send a NAMES for channel; the Deferred fires with the names as
+        sent by the server, status prefixes and all.
+
+        """
+        return self.queries.request('NAMES', channel, timeout).addCallback(
+            lambda lines: [name for command, params in lines
+                if command == '353' for name in params[3].split()])
+
+    def ask(self, nickname, question, timeout=300):
+        """Send nickname a question and wait for the answer.
+
+        Returns a Deferred that fires with the next private message from
+        nickname, which isn't passed on to the plugs.
+
+        """
+        key = self.users.fold(nickname)
+        self._asks.setdefault(key, (None, []))
+        self.msg(nickname, question)
+        return self._wait(self._asks, key, timeout)
+
     def add_command(self, cmd, plug):
         """Add a callback for a specific !commmand.
 
@@ -357,8 +1068,10 @@ class Shirk(irc.IRCClient):
         if cmd not in self.hooks[Event.command]:
             self.hooks[Event.command][cmd] = set()
         self.hooks[Event.command][cmd].add(plug)
+        self.generation += 1
 
-    def add_callback(self, event, plug):
+    def add_callback(self, event, plug, channels=None, nicks=None,
+                     prefixes=None):
         """Add a callback for a given event.
 
         This method is for those events that do not have a more specific
@@ -368,17 +1081,33 @@ class Shirk(irc.IRCClient):
         event: One of the constant attributes of util.Event.
         plug: The plug that's requesting to be poked in the event of an
             event.
+        channels, nicks, prefixes: Optional lists to only be called for
+            some of the events, see subscriptions.py.
 
         Returns true if the callback is now registered, false if the event
-        doesn't exist.
+        doesn't exist.  Raises ValueError for filters that don't apply to
+        the event.
 
         """
         if event not in self.hooks:
             return False
+        elif channels or nicks or prefixes:
+            self.subscriptions.add(event, plug, channels, nicks, prefixes)
+            return True
         else:
             self.hooks[event].add(plug)
             return True
 
+    def add_trigger(self, trigger, plug):
+        """Add a callback for channel messages matching trigger.
+
+        trigger: A string, matched case insensitively as a whole word, or a
+            compiled regex that is searched for.  See triggers.py.
+        plug: The plug that wants to be notified.
+
+        """
+        self.triggers.add(trigger, plug)
+
     def add_raw(self, cmd, plug):
         """Add a callback for a raw IRC command.
 
@@ -395,12 +1124,61 @@ class Shirk(irc.IRCClient):
         self.hooks[Event.raw][cmd].add(plug)
 
 
+class Hangup(protocol.Protocol):
+    """Closes the connection as soon as it's made."""
+
+    def connectionMade(self):
+        self.transport.loseConnection()
+
+
+class Attempt(protocol.ClientFactory):
+    """One of the connections ShirkFactory races, to server at address."""
+
+    def __init__(self, factory, server, address):
+        self.factory = factory
+        self.server = server
+        self.address = address
+        self.started = time.time()
+        self.connected = None
+        self.handshaken = None
+        self.connector = None
+        self.tls = None
+        self.won = False
+
+    def buildProtocol(self, addr):
+        p = self.factory.attempt_connected(self, addr)
+        if p is None:
+            # Lost the race.  TLS wraps whatever's returned here, so it has
+            # to be a protocol rather than None.
+            p = Hangup()
+        return p
+
+    def clientConnectionFailed(self, connector, reason):
+        self.factory.attempt_failed(self, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        # Losers are dropped without a protocol, nobody cares about them.
+        if self.won:
+            self.factory.clientConnectionLost(connector, reason)
+
+
 class ShirkFactory(protocol.ReconnectingClientFactory):
     """A factory for Shirk.
 
     A new protocol instance will be created each time we connect to the server.
 
+    Where to connect to comes from a servers.ServerPool.  Every time around,
+    the best few addresses are raced: attempts start stagger seconds apart,
+    or right away when the one before fails, and the first to connect wins
+    while the others are dropped.  As long as some server in the pool is
+    healthy, a failed round is retried after reconn_delay; only once they're
+    all failing does the delay grow exponentially.
+
     """
+    # A connection that dies within this many seconds counts against the
+    # server's health.
+    stable_time = 60
+
     def __init__(self, config, logger):
         self.shuttingdown = False
         self.config = config
@@ -411,6 +1189,21 @@ class ShirkFactory(protocol.ReconnectingClientFactory):
         self.initialDelay = config['reconn_delay']
         self.delay = self.initialDelay
         self.maxRetries = config['reconn_tries']
+        self.jitter = config['reconn_jitter']
+        # Delay between sent lines the last connection settled on
+        self.line_rate = None
+        self.pool = servers.ServerPool(config['servers'] or
+            ['%s:%d' % (config['server'], config['port'])],
+            **config['server_pool'])
+        self.attempts = []
+        # Servers that failed an attempt in the current round
+        self.failed_servers = []
+        self.candidates = []
+        self.next_attempt = None
+        self.winner = None
+        self.tls = None
+        if config['ssl']:
+            self.tls = tls.TLSSettings(config['ssl_ca'], config['ssl_cert'])
 
     def buildProtocol(self, addr):
         p = Shirk()
@@ -418,36 +1211,134 @@ class ShirkFactory(protocol.ReconnectingClientFactory):
         p.config = self.config
         return p
 
+    def connect(self):
+        """Start a round of connection attempts."""
+        self.pool.start()
+        self.attempts = []
+        self.failed_servers = []
+        self.winner = None
+        self.candidates = self.pool.candidates()
+        self.start_attempt()
+
+    def start_attempt(self):
+        self.next_attempt = None
+        server, address = self.candidates.pop(0)
+        attempt = Attempt(self, server, address)
+        self.attempts.append(attempt)
+        self.log.info('Connecting to %s (%s)' % (server, address))
+        if self.tls is not None:
+            attempt.tls = self.tls.creator(server.host, server.port)
+            attempt.connector = reactor.connectSSL(address, server.port,
+                attempt, attempt.tls, timeout=self.pool.connect_timeout)
+        else:
+            attempt.connector = reactor.connectTCP(address, server.port,
+                attempt, timeout=self.pool.connect_timeout)
+        if self.candidates:
+            self.next_attempt = reactor.callLater(self.pool.stagger,
+                                                  self.start_attempt)
+
+    def attempt_connected(self, attempt, addr):
+        if self.winner is not None:
+            return None
+        self.winner = attempt
+        attempt.won = True
+        attempt.connected = time.time()
+        self.pool.succeeded(attempt.server,
+                            attempt.connected - attempt.started)
+        if self.next_attempt is not None:
+            self.next_attempt.cancel()
+            self.next_attempt = None
+        # stopConnecting() has attempt_failed() take the attempt out of the
+        # list right away.
+        for other in list(self.attempts):
+            if other is not attempt and other.connector.state == 'connecting':
+                other.connector.stopConnecting()
+        self.candidates = []
+        self.penalize(exclude=attempt.server.host)
+        return self.buildProtocol(addr)
+
+    def attempt_failed(self, attempt, reason):
+        self.attempts.remove(attempt)
+        if self.winner is not None:
+            return
+        self.log.info('Could not connect to %s (%s): %s' % (attempt.server,
+            attempt.address, reason.getErrorMessage()))
+        self.failed_servers.append(attempt.server)
+        if self.candidates:
+            if self.next_attempt is not None:
+                self.next_attempt.cancel()
+            self.start_attempt()
+        elif not self.attempts:
+            self.penalize()
+            self.clientConnectionFailed(attempt.connector, reason)
+
+    def penalize(self, exclude=None):
+        """Count the round against each server that failed in it, once.
+
+        A server that has another address connect in the same round isn't
+        failing as a whole, so that's excluded.
+
+        """
+        penalized = set([exclude])
+        for server in self.failed_servers:
+            if server.host not in penalized:
+                penalized.add(server.host)
+                self.pool.failed(server)
+        self.failed_servers = []
+
+    def retry(self, connector=None):
+        """Start another round through the pool after a suitable delay.
+
+        ReconnectingClientFactory works out the delay and counts the
+        retries; it just reconnects through connect() instead of the
+        connector that failed.
+
+        """
+        if self.pool.any_healthy():
+            # Another server might well work, no need to back off.
+            self.delay = self.initialDelay / self.factor
+        protocol.ReconnectingClientFactory.retry(self, PoolConnector(self))
+
     def clientConnectionLost(self, connector, reason):
         """If we get disconnected, reconnect to server."""
         if self.shuttingdown:
             self.log.info('Shutting down')
+            self.pool.stop()
             reactor.stop()
         else:
             self.log.info('Lost connection.')
+            if time.time() - self.winner.connected < self.stable_time:
+                self.pool.failed(self.winner.server)
             protocol.ReconnectingClientFactory.clientConnectionLost(
                 self, connector, reason)
             self.log.info('Attempting reconnection in %d seconds.'
                 % (self.delay,))
 
     def clientConnectionFailed(self, connector, reason):
-        """Failed to connect to the server, so try to reconnect.
-
-        Todo: write something nice to reconnect with increasing intervals.
-
-        """
+        """Failed to connect to any server, so try to reconnect."""
         self.log.info('Connection failed.')
         protocol.ReconnectingClientFactory.clientConnectionFailed(
             self, connector, reason)
         if self.maxRetries is not None and (self.retries > self.maxRetries):
             self.log.error('Abandoning reconnection after %d tries'
                 % (self.retries,))
+            self.pool.stop()
             reactor.stop()
         else:
             self.log.info('Attempting reconnection in %d seconds.'
                 % (self.delay,))
 
 
+class PoolConnector(object):
+    """What ReconnectingClientFactory.retry reconnects, see there."""
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def connect(self):
+        self.factory.connect()
+
+
 if __name__ == '__main__':
     # set up default config dictionary
     config = {
@@ -466,8 +1357,28 @@ if __name__ == '__main__':
         'channels': [],
         'server': 'chat.freenode.net',
         'port': 6667,
+        # Connect with TLS, which needs pyOpenSSL and service_identity
+        'ssl': False,
+        # PEM file with the CA certificates to trust instead of the system's,
+        # for servers with a self-signed certificate
+        'ssl_ca': None,
+        # PEM file with a client certificate and key, for CertFP or SASL
+        # EXTERNAL
+        'ssl_cert': None,
+        # SASL authentication during capability negotiation, either
+        # {"mechanism": "PLAIN", "username": ..., "password": ...} or
+        # {"mechanism": "EXTERNAL"} to log in with ssl_cert
+        'sasl': {},
+        # Several 'host:port' servers of the same network to choose from;
+        # when empty, server and port are used.
+        'servers': [],
+        # How servers are picked, see servers.ServerPool for the options:
+        # resolve_ttl, race, stagger, connect_timeout and max_penalty.
+        'server_pool': {},
         # The plugs to load at startup.
         'plugs': ['Core', 'Auth'],
+        # Only load plugs that have a manifest.json when they're first needed.
+        'lazy_plugs': True,
         # The prefix for !commands (or +commands, or @commands, or..)
         'cmd_prefix': '!',
         # Initial delay between reconnections when there's a connection
@@ -475,8 +1386,33 @@ if __name__ == '__main__':
         'reconn_delay': 1,
         # Maximum reconnection retries
         'reconn_tries': 8,
+        # Random spread of reconnection delays, as a fraction of the delay,
+        # so a lot of bots don't all come back at the same time.
+        'reconn_jitter': 0.25,
         # charset used to decode messages
-        'charset': 'utf-8'
+        'charset': 'utf-8',
+        # Command rate limiting, see ratelimit.RateLimiter for the options:
+        # user_rate, user_burst, channel_rate, channel_burst, costs,
+        # repeat_window, max_buckets and exempt_power.
+        'rate_limit': {},
+        # Number of WHO/WHOIS/NAMES/MODE queries to have in flight at once
+        'query_pipeline': 4,
+        # Handling of incoming floods, see inbound.Inbound for the options:
+        # slice_time, high_water, low_water, lossy_water and fast_power.
+        'inbound': {},
+        # Seconds to remember users lost in a netsplit before giving up on
+        # them coming back
+        'split_timeout': 1800,
+        # Lag measurement and send pacing, see lag.LagMeter for the options:
+        # interval, timeout, history, rate, min_rate, max_rate, low_lag,
+        # high_lag and warn_lag.
+        'lag': {},
+        # Timers for plugs, see scheduler.Scheduler for the options: db_path,
+        # tick, slots and levels.
+        'scheduler': {},
+        # IRCv3 capabilities to request if the server offers them
+        'caps': ['multi-prefix', 'extended-join', 'account-notify',
+                 'away-notify', 'userhost-in-names', 'batch', 'message-tags']
     }
     config.update(json.load(open('conf.json')))
     
@@ -500,6 +1436,6 @@ if __name__ == '__main__':
 
     # Create and connect the client factory
     f = ShirkFactory(config, logger)
-    reactor.connectTCP(config['server'], config['port'], f)
+    f.connect()
     # Push the big red button
     reactor.run()
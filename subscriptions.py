@@ -0,0 +1,170 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Event subscriptions that only want some of the events.
+
+A plug that hooks chanmsg normally gets every message in every channel.
+With filters it only gets called for what it asked for:
+
+* channels: a list of channels.  Subscriptions are indexed on these, so an
+  event in a channel only looks at the plugs that asked for that channel.
+  For events without a channel, like userquit, the user has to be in one
+  of the channels.
+* nicks: a list of masks for the user the event is about.  Masks with a !
+  in them are matched against nick!user@host, others against the nick; *
+  and ? are wildcards.
+* prefixes: a list of strings, one of which the message has to start with.
+
+Filters only apply to the events that carry the information, see
+FILTERABLE.  Plugs ask for them with (event, {filters}) entries in their
+hooks, or by passing them to Shirk.add_callback.
+
+"""
+
+import re
+
+from channels import mask_regex
+from util import Event
+
+
+# Event: which of channels, nicks and prefixes make sense for it
+FILTERABLE = {
+    Event.addressed: ('channels', 'nicks', 'prefixes'),
+    Event.chanmsg: ('channels', 'nicks', 'prefixes'),
+    Event.private: ('nicks', 'prefixes'),
+    Event.userjoined: ('channels', 'nicks'),
+    Event.userleft: ('channels', 'nicks'),
+    Event.userquit: ('channels', 'nicks'),
+    Event.userrenamed: ('channels', 'nicks'),
+}
+
+
+class Subscription(object):
+    """A plug's filtered subscription to one event."""
+
+    def __init__(self, plug, channels=None, nicks=None, prefixes=None):
+        self.plug = plug
+        self.channels = channels
+        self.nicks = nicks
+        self.prefixes = tuple(prefixes) if prefixes else None
+        # Compiled by Subscriptions.compile, as they depend on casemapping.
+        self.folded_channels = None
+        self.nick_regex = None
+        self.mask_regex = None
+
+    def compile(self, fold):
+        if self.channels:
+            self.folded_channels = set(fold(channel)
+                                       for channel in self.channels)
+        if self.nicks:
+            nicks = [fold(mask) for mask in self.nicks if '!' not in mask]
+            masks = [fold(mask) for mask in self.nicks if '!' in mask]
+            if nicks:
+                self.nick_regex = re.compile('(?:%s)\\Z'
+                    % ('|'.join(mask_regex(nick) for nick in nicks),), re.S)
+            if masks:
+                self.mask_regex = re.compile('(?:%s)\\Z'
+                    % ('|'.join(mask_regex(mask) for mask in masks),), re.S)
+
+
+class Subscriptions(object):
+    """The filtered subscriptions of all plugs.
+
+    core is the Shirk instance, for casefolding and for looking up the
+    channels and hostmask of users.  Unfiltered subscriptions stay in
+    Shirk.hooks; this is only for the filtered ones.
+
+    """
+    def __init__(self, core):
+        self.core = core
+        # {event: [Subscription]}
+        self.subscriptions = {}
+        # {event: {folded channel: [Subscription]}} and
+        # {event: [Subscription]} for those without channels
+        self.by_channel = {}
+        self.unscoped = {}
+        self.stale = False
+
+    def add(self, event, plug, channels=None, nicks=None, prefixes=None):
+        """Add a filtered subscription; raises ValueError for filters that
+        don't apply to event.
+
+        """
+        allowed = FILTERABLE.get(event, ())
+        for name, value in (('channels', channels), ('nicks', nicks),
+                            ('prefixes', prefixes)):
+            if value and name not in allowed:
+                raise ValueError('%s can\'t be filtered on %s'
+                    % (event, name))
+        self.subscriptions.setdefault(event, []).append(
+            Subscription(plug, channels, nicks, prefixes))
+        self.stale = True
+
+    def remove_plug(self, plug):
+        for event, subscriptions in self.subscriptions.items():
+            kept = [sub for sub in subscriptions if sub.plug is not plug]
+            if len(kept) != len(subscriptions):
+                self.subscriptions[event] = kept
+                self.stale = True
+
+    def compile(self):
+        """Rebuild the indexes, after changes or a new casemapping."""
+        fold = self.core.users.fold
+        self.by_channel = {}
+        self.unscoped = {}
+        for event, subscriptions in self.subscriptions.iteritems():
+            index = self.by_channel[event] = {}
+            unscoped = self.unscoped[event] = []
+            for sub in subscriptions:
+                sub.compile(fold)
+                if sub.folded_channels:
+                    for channel in sub.folded_channels:
+                        index.setdefault(channel, []).append(sub)
+                else:
+                    unscoped.append(sub)
+        self.stale = False
+
+    def select(self, event, channel=None, nickname=None, msg=None):
+        """The plugs whose filters let this event through."""
+        if not self.subscriptions.get(event):
+            return set()
+        if self.stale:
+            self.compile()
+        fold = self.core.users.fold
+        if channel is not None:
+            candidates = self.by_channel[event].get(fold(channel), [])
+        elif nickname is not None:
+            # Only the channels the user is in are of interest.
+            user = self.core.users.by_nick(nickname)
+            candidates = []
+            if user is not None:
+                index = self.by_channel[event]
+                seen = set()
+                for key in user.channels:
+                    for sub in index.get(key, ()):
+                        if sub not in seen:
+                            seen.add(sub)
+                            candidates.append(sub)
+        else:
+            candidates = []
+        plugs = set()
+        hostmask = None
+        for sub in candidates + self.unscoped[event]:
+            if sub.prefixes and not (msg or '').startswith(sub.prefixes):
+                continue
+            if sub.nick_regex is not None or sub.mask_regex is not None:
+                if nickname is None:
+                    continue
+                folded = fold(nickname)
+                matched = sub.nick_regex is not None and \
+                    sub.nick_regex.match(folded)
+                if not matched and sub.mask_regex is not None:
+                    if hostmask is None:
+                        user = self.core.users.by_nick(nickname)
+                        hostmask = fold('%s!%s@%s' % (nickname,
+                            user.username, user.hostmask)) if user else ''
+                    matched = sub.mask_regex.match(hostmask)
+                if not matched:
+                    continue
+            plugs.add(sub.plug)
+        return plugs
@@ -0,0 +1,7 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Tests for Shirk, run from the top directory with
+`python -m twisted.trial tests`.
+
+"""
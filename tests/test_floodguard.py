@@ -0,0 +1,61 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import logging
+
+from twisted.trial import unittest
+
+import channels
+import scheduler
+import users
+from plugs.FloodGuard import floodguard
+
+
+class Core(object):
+    """Just enough of Shirk for FloodGuard and saved timers."""
+
+    def __init__(self):
+        self.log = logging.getLogger('test')
+        self.nickname = 'shirk'
+        self.users = users.Users(self)
+        self.channels = channels.Channels(self)
+        self.scheduler = scheduler.Scheduler(self, db_path=':memory:')
+        self.plugs = {}
+        self.sent = []
+
+    def modes(self, channel, changes):
+        self.sent.append((channel, changes))
+
+
+class UnbanTests(unittest.TestCase):
+
+    def setUp(self):
+        self.core = Core()
+        self.addCleanup(self.core.scheduler.stop)
+        self.plug = floodguard.FloodGuardPlug(self.core)
+        self.core.plugs[self.plug.name] = self.plug
+        self.core.channels.joined('#chan')
+
+    def saved(self):
+        return list(self.core.scheduler.db.execute(
+            'SELECT id, method, args FROM jobs'))
+
+    def test_unban_before_opped(self):
+        """A saved unban that comes due before the bot is opped again, as
+        after a restart, is saved for later rather than lost.
+
+        """
+        job = self.core.scheduler.save(0, 'FloodGuard', 'unban',
+                                       ('#chan', ['*!*@bad']))
+        self.core.scheduler.run_saved(job.job, 'FloodGuard', 'unban',
+                                      ('#chan', ['*!*@bad']))
+        self.core.scheduler.forget_timer(job)
+        self.assertEqual(self.core.sent, [])
+        [(retry, method, args)] = self.saved()
+        self.assertEqual(method, 'unban')
+        self.assertEqual(args, '["#chan", ["*!*@bad"], 1]')
+        chan = self.core.channels.get('#chan')
+        chan.add('shirk', 'shirk', 'o')
+        self.core.scheduler.run_saved(retry, 'FloodGuard', 'unban',
+                                      (u'#chan', [u'*!*@bad'], 1))
+        self.assertEqual(self.core.sent, [(u'#chan', [u'-b *!*@bad'])])
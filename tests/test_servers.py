@@ -0,0 +1,213 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import logging
+import socket
+import time
+
+from twisted.internet import defer, protocol, reactor
+from twisted.trial import unittest
+
+import servers
+import shirk
+
+
+def refusing_port():
+    """A port on 127.0.0.1 that nothing listens on."""
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class Client(protocol.Protocol):
+
+    def connectionMade(self):
+        self.factory.done.callback(self)
+
+
+class RaceFactory(shirk.ShirkFactory):
+    """ShirkFactory that reports how a round ended instead of retrying."""
+
+    def __init__(self, server_list, ssl_ca=None, **pool):
+        config = {'reconn_delay': 1, 'reconn_tries': 0, 'reconn_jitter': 0,
+                  'servers': server_list, 'server_pool': pool,
+                  'ssl': ssl_ca is not None, 'ssl_ca': ssl_ca,
+                  'ssl_cert': None}
+        shirk.ShirkFactory.__init__(self, config, logging.getLogger('test'))
+        self.done = defer.Deferred()
+        self.lost = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        p = Client()
+        p.factory = self
+        return p
+
+    def clientConnectionFailed(self, connector, reason):
+        self.done.callback(None)
+
+    def clientConnectionLost(self, connector, reason):
+        self.lost.callback(None)
+
+
+class ServerPoolTests(unittest.TestCase):
+
+    def test_health_per_host(self):
+        """Every port of a host shares one health record."""
+        pool = servers.ServerPool(['a.example:1', 'a.example:2',
+                                   'b.example:1'])
+        first, second, other = pool.servers
+        pool.failed(first)
+        now = time.time()
+        self.assertFalse(second.healthy(now))
+        self.assertTrue(other.healthy(now))
+        self.assertEqual(pool.ranked()[0], other)
+        pool.succeeded(second, 0.1)
+        self.assertTrue(first.healthy(time.time()))
+
+
+class RaceTests(unittest.TestCase):
+    """Connection rounds against local listeners that refuse, hang or
+    accept.
+
+    """
+    timeout = 10
+
+    def setUp(self):
+        self.listening = []
+        self.sockets = []
+        self.connections = []
+
+    def tearDown(self):
+        for s in self.sockets:
+            s.close()
+        return defer.DeferredList([port.stopListening()
+                                   for port in self.listening])
+
+    def accepting_port(self):
+        """A port on 127.0.0.1 that accepts connections."""
+        lost = self.connections
+        class Accepted(protocol.Protocol):
+            def connectionMade(self):
+                self.lost = defer.Deferred()
+                lost.append(self.lost)
+            def connectionLost(self, reason):
+                self.lost.callback(None)
+        factory = protocol.ServerFactory()
+        factory.protocol = Accepted
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.listening.append(port)
+        return port.getHost().port
+
+    def hanging_port(self):
+        """A port on 127.0.0.1 whose backlog is full, so connecting to it
+        hangs until the attempt times out.
+
+        """
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        s.listen(0)
+        port = s.getsockname()[1]
+        self.sockets.append(s)
+        for i in xrange(4):
+            filler = socket.socket()
+            filler.setblocking(False)
+            filler.connect_ex(('127.0.0.1', port))
+            self.sockets.append(filler)
+        return port
+
+    def run_round(self, server_list, addresses=('127.0.0.1',), **pool):
+        """Start a round, with every server at addresses."""
+        factory = RaceFactory(server_list, **pool)
+        self.addCleanup(factory.pool.stop)
+        # The names are made up, keep the pool from resolving them.
+        for server in factory.pool.servers:
+            server.addresses = list(addresses)
+            server.resolved = time.time()
+        factory.connect()
+        return factory, factory.done
+
+    def disconnect(self, client, factory):
+        client.transport.loseConnection()
+        return defer.DeferredList([factory.lost] + self.connections)
+
+    @defer.inlineCallbacks
+    def test_refused(self):
+        """A refused attempt starts the next one without waiting for the
+        stagger, and counts against the server that refused.
+
+        """
+        good = self.accepting_port()
+        factory, done = self.run_round(
+            ['refusing:%d' % (refusing_port(),), 'good:%d' % (good,)],
+            race=2, stagger=5)
+        client = yield done
+        self.assertNotIdentical(client, None)
+        self.assertEqual(factory.winner.server.host, 'good')
+        self.assertEqual(factory.pool.health['refusing'].failures, 1)
+        self.assertEqual(factory.pool.health['good'].failures, 0)
+        yield self.disconnect(client, factory)
+
+    @defer.inlineCallbacks
+    def test_hanging(self):
+        """A hanging attempt is overtaken by the next one, which wins well
+        before the first times out.
+
+        """
+        good = self.accepting_port()
+        started = time.time()
+        factory, done = self.run_round(
+            ['hanging:%d' % (self.hanging_port(),), 'good:%d' % (good,)],
+            race=2, stagger=0.1, connect_timeout=5)
+        client = yield done
+        self.assertEqual(factory.winner.server.host, 'good')
+        self.assertTrue(time.time() - started < 2)
+        self.assertEqual(factory.pool.health['hanging'].failures, 0)
+        yield self.disconnect(client, factory)
+
+    @defer.inlineCallbacks
+    def test_losers_stopped(self):
+        """Every attempt still connecting when one wins is stopped, however
+        many there are.
+
+        """
+        good = self.accepting_port()
+        factory, done = self.run_round(
+            ['hanging1:%d' % (self.hanging_port(),),
+             'hanging2:%d' % (self.hanging_port(),), 'good:%d' % (good,)],
+            race=3, stagger=0.1, connect_timeout=5)
+        client = yield done
+        self.assertEqual(factory.winner.server.host, 'good')
+        self.assertEqual([attempt.server.host for attempt in factory.attempts
+                          if attempt.connector.state == 'connecting'], [])
+        yield self.disconnect(client, factory)
+
+    @defer.inlineCallbacks
+    def test_all_fail(self):
+        """A round where nothing connects counts once against each
+        server.
+
+        """
+        factory, done = self.run_round(
+            ['refusing:%d' % (refusing_port(),),
+             'hanging:%d' % (self.hanging_port(),)],
+            race=2, stagger=0.1, connect_timeout=0.5)
+        result = yield done
+        self.assertIdentical(result, None)
+        self.assertEqual(factory.pool.health['refusing'].failures, 1)
+        self.assertEqual(factory.pool.health['hanging'].failures, 1)
+
+    @defer.inlineCallbacks
+    def test_addresses_fail_together(self):
+        """A server whose addresses all refuse fails once, not once per
+        address.
+
+        """
+        factory, done = self.run_round(['refusing:%d' % (refusing_port(),)],
+                                       addresses=['127.0.0.1', '127.0.0.2'],
+                                       race=2)
+        result = yield done
+        self.assertIdentical(result, None)
+        self.assertEqual(len(factory.attempts), 0)
+        self.assertEqual(factory.pool.health['refusing'].failures, 1)
@@ -0,0 +1,48 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import logging
+
+from twisted.trial import unittest
+
+import ratelimit
+import shirk
+import users
+
+
+class TagTests(unittest.TestCase):
+
+    def test_unescape(self):
+        """Every IRCv3 escape is undone, unknown ones stand for the bare
+        character and a lone trailing backslash is dropped.
+
+        """
+        self.assertEqual(shirk.unescape_tag(u'a\\:b\\sc\\\\d\\re\\nf'),
+                         u'a;b c\\d\re\nf')
+        self.assertEqual(shirk.unescape_tag(u'\\x\\'), u'x')
+
+
+class PrivateTests(unittest.TestCase):
+    """Private messages and actions against a bot without a connection."""
+
+    def setUp(self):
+        self.bot = shirk.Shirk()
+        self.bot.log = logging.getLogger('test')
+        self.bot.nickname = 'shirk'
+        self.bot.cmd_prefix = '!'
+        self.bot.users = users.Users(self.bot)
+        self.bot.ratelimit = ratelimit.RateLimiter(user_rate=0.001,
+                                                   user_burst=1)
+        self.private = []
+        self.bot.event_private = lambda source, msg, action: \
+            self.private.append((source, msg, action))
+
+    def test_action_limited(self):
+        """A private /me goes through the rate limiter like a private
+        message does.
+
+        """
+        for i in xrange(3):
+            self.bot.action('someone!user@host', 'shirk', 'waves')
+        self.bot.privmsg('someone!user@host', 'shirk', 'hi')
+        self.assertEqual(self.private, [('someone', 'waves', True)])
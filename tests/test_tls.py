@@ -0,0 +1,176 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import time
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import basic
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+import shirk
+import tls
+from tests.test_servers import RaceFactory
+
+try:
+    from OpenSSL import SSL, crypto
+    from twisted.internet import ssl
+except ImportError:
+    crypto = None
+
+
+def self_signed(name):
+    """A key and a self-signed certificate for name, as PEM."""
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = name
+    cert.set_serial_number(int(time.time() * 1000))
+    cert.gmtime_adj_notBefore(-60)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.add_extensions([crypto.X509Extension(
+        b'subjectAltName', False, b'DNS:' + name.encode('ascii'))])
+    cert.sign(key, 'sha256')
+    return (crypto.dump_privatekey(crypto.FILETYPE_PEM, key),
+            crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+
+class Server(basic.LineReceiver):
+    """Says hello, which is the first line the client waits for."""
+
+    def connectionMade(self):
+        self.lost = defer.Deferred()
+        self.factory.connections.append(self.lost)
+        self.sendLine(':localhost NOTICE * :Hello')
+
+    def connectionLost(self, reason):
+        self.lost.callback(None)
+
+
+class Client(basic.LineReceiver):
+    """Finishes the TLS handshake bookkeeping the way Shirk does."""
+
+    def lineReceived(self, line):
+        if not self.factory.done.called:
+            self.factory.winner.tls.handshake_done()
+            self.factory.done.callback(self)
+
+
+class TLSFactory(RaceFactory):
+
+    def buildProtocol(self, addr):
+        p = Client()
+        p.factory = self
+        return p
+
+
+class SessionReusedTests(unittest.TestCase):
+
+    if crypto is None:
+        skip = 'TLS needs pyOpenSSL and service_identity'
+
+    def test_unknown(self):
+        """Without the private OpenSSL binding to ask, whether a session
+        was resumed is unknown rather than an error.
+
+        """
+        connection = SSL.Connection(SSL.Context(SSL.SSLv23_METHOD))
+        self.assertFalse(tls.session_reused(connection))
+        self.patch(SSL, '_lib', object())
+        self.assertIdentical(tls.session_reused(connection), None)
+
+
+class TLSTests(unittest.TestCase):
+    """Connections to a local TLS server with a self-signed certificate."""
+
+    timeout = 10
+    if crypto is None:
+        skip = 'TLS needs pyOpenSSL and service_identity'
+
+    def setUp(self):
+        key, cert = self_signed(u'localhost')
+        other_key, other_cert = self_signed(u'unrelated')
+        # The server's certificate is the second in the file, which has to
+        # be trusted all the same.
+        self.ca = self.mktemp()
+        with open(self.ca, 'w') as f:
+            f.write(other_cert + cert)
+        self.untrusted = self.mktemp()
+        with open(self.untrusted, 'w') as f:
+            f.write(other_cert)
+        options = ssl.PrivateCertificate.loadPEM(key + cert).options()
+        factory = protocol.ServerFactory()
+        factory.protocol = Server
+        factory.connections = self.connections = []
+        port = reactor.listenSSL(0, factory, options, interface='127.0.0.1')
+        self.port = port.getHost().port
+        self.listening = [port]
+
+    def tearDown(self):
+        return defer.DeferredList([port.stopListening()
+                                   for port in self.listening])
+
+    def factory(self, ca):
+        factory = TLSFactory(['localhost:%d' % (self.port,)], ssl_ca=ca,
+                             connect_timeout=5)
+        self.addCleanup(factory.pool.stop)
+        server = factory.pool.servers[0]
+        server.addresses = ['127.0.0.1']
+        server.resolved = time.time()
+        return factory
+
+    def connect(self, factory):
+        factory.done = defer.Deferred()
+        factory.lost = defer.Deferred()
+        factory.connect()
+        return factory.done
+
+    def disconnect(self, client, factory):
+        client.transport.loseConnection()
+        return defer.DeferredList([factory.lost] + self.connections)
+
+    @defer.inlineCallbacks
+    def test_resumption(self):
+        """The server's certificate is trusted through ssl_ca, and a
+        reconnect resumes the first connection's session.
+
+        """
+        factory = self.factory(self.ca)
+        client = yield self.connect(factory)
+        self.assertFalse(factory.winner.tls.resumed)
+        yield self.disconnect(client, factory)
+        client = yield self.connect(factory)
+        self.assertTrue(factory.winner.tls.resumed)
+        yield self.disconnect(client, factory)
+
+    @defer.inlineCallbacks
+    def test_untrusted(self):
+        """Without the server's certificate in ssl_ca, the handshake fails
+        and no line gets through.
+
+        """
+        factory = self.factory(self.untrusted)
+        factory.connect()
+        yield defer.DeferredList([factory.lost] + self.connections)
+        self.assertFalse(factory.done.called)
+        self.flushLoggedErrors()
+
+    def test_losing_attempt(self):
+        """An attempt that connects after another won gets a protocol that
+        TLS can wrap, and hangs up.
+
+        """
+        factory = self.factory(self.ca)
+        server = factory.pool.servers[0]
+        winner = shirk.Attempt(factory, server, '127.0.0.1')
+        factory.attempt_connected(winner, None)
+        loser = shirk.Attempt(factory, server, '127.0.0.1')
+        loser.tls = factory.tls.creator(server.host, server.port)
+        wrapper = TLSMemoryBIOFactory(loser.tls, True, loser)
+        p = wrapper.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        p.makeConnection(transport)
+        self.assertTrue(transport.disconnecting)
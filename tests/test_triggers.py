@@ -0,0 +1,45 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+import re
+
+from twisted.trial import unittest
+
+import triggers
+
+
+class TriggerRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = triggers.TriggerRegistry()
+
+    def test_keyword(self):
+        self.registry.add('shirk', 'plug')
+        self.assertEqual(self.registry.match('hi Shirk!'),
+                         [('plug', 'shirk', None)])
+        self.assertEqual(self.registry.match('shirks'), [])
+
+    def test_gate(self):
+        """Regexes without a usable literal share a gate."""
+        first = re.compile(r'(\d+)x')
+        second = re.compile(r'y(\d+)')
+        self.registry.add(first, 'one')
+        self.registry.add(second, 'two')
+        found = self.registry.match('3x y4')
+        self.registry.compile()
+        self.assertEqual(len(self.registry.gates), 1)
+        self.assertEqual(sorted((plug, match.group(1))
+                                for plug, regex, match in found),
+                         [('one', '3'), ('two', '4')])
+
+    def test_same_group_names(self):
+        """Regexes that use the same group name don't break matching."""
+        first = re.compile(r'(?P<n>\d+)x')
+        second = re.compile(r'y(?P<n>\d+)')
+        self.registry.add(first, 'one')
+        self.registry.add(second, 'two')
+        found = self.registry.match('3x y4')
+        self.assertEqual(sorted((plug, match.group('n'))
+                                for plug, regex, match in found),
+                         [('one', '3'), ('two', '4')])
+        self.assertFalse(self.registry.stale)
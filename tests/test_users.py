@@ -0,0 +1,63 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+import users
+
+
+class Core(object):
+    """Records the events Users fires."""
+
+    def __init__(self):
+        self.events = []
+
+    def event_usercreated(self, user):
+        pass
+
+    def event_userremoved(self, user):
+        self.events.append(('removed', user.nickname))
+
+    def event_netsplit(self, message, lost):
+        self.events.append(('netsplit', [u.nickname for u in lost]))
+
+    def event_netjoin(self, message, back):
+        self.events.append(('netjoin', [u.nickname for u in back]))
+
+
+class NetsplitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(users, 'reactor', self.clock)
+        self.core = Core()
+        self.users = users.Users(self.core, split_timeout=60, batch_delay=1)
+        for nick in ('alice', 'bob'):
+            self.users.user_joined(nick, 'u', nick + '.example', '#chan')
+
+    def test_replaced_before_netjoin(self):
+        """A user whose nick was taken by someone else before the netjoin
+        event went out isn't in it.
+
+        """
+        self.users.user_quit('alice', 'hub.example leaf.example')
+        self.users.user_quit('bob', 'hub.example leaf.example')
+        self.clock.advance(1)
+        self.users.user_joined('alice', 'u', 'alice.example', '#chan')
+        self.users.user_joined('bob', 'u', 'bob.example', '#chan')
+        self.users.user_quit('bob')
+        self.clock.advance(1)
+        self.assertEqual(self.core.events, [
+            ('netsplit', ['alice', 'bob']), ('removed', 'bob'),
+            ('netjoin', ['alice'])])
+
+    def test_deleted_before_netsplit(self):
+        """A split user deleted before the netsplit event went out isn't in
+        it, and an emptied batch isn't sent at all.
+
+        """
+        self.users.user_quit('alice', 'hub.example leaf.example')
+        self.users.user_joined('alice', 'x', 'elsewhere.example', '#chan')
+        self.clock.advance(1)
+        self.assertEqual(self.core.events, [('removed', 'alice')])
@@ -0,0 +1,108 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""TLS for Shirk's connections.
+
+Needs pyOpenSSL, and service_identity to check the server's hostname;
+without them Shirk can only connect in plaintext.  Certificates are always
+verified, against the system's CAs or against the ones in ssl_ca for
+servers with a self-signed certificate.
+
+TLS sessions are remembered per server, so a reconnect can resume the last
+session instead of going through a full handshake.
+
+"""
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+
+try:
+    from OpenSSL import SSL
+    from twisted.internet import ssl
+except ImportError:
+    ssl = None
+
+
+def load_certificates(path):
+    """All certificates in the PEM file at path."""
+    end = '-----END CERTIFICATE-----'
+    with open(path) as f:
+        blocks = f.read().split(end)
+    return [ssl.Certificate.loadPEM(block + end) for block in blocks
+            if '-----BEGIN CERTIFICATE-----' in block]
+
+
+def session_reused(connection):
+    """Whether connection's handshake resumed an earlier session, or None if
+    there's no telling.
+
+    """
+    # pyOpenSSL has no call for this, so ask OpenSSL itself through
+    # pyOpenSSL's private bindings, which may change or go away.
+    reused = getattr(getattr(SSL, '_lib', None), 'SSL_session_reused', None)
+    if reused is None:
+        return None
+    try:
+        return bool(reused(connection._ssl))
+    except (AttributeError, TypeError):
+        return None
+
+
+class TLSSettings(object):
+    """Client TLS settings and sessions, shared by all connection attempts.
+
+    ca: path of a PEM file with the CA certificates to trust instead of the
+        system's, or None.
+    cert: path of a PEM file with a client certificate and its key, for
+        CertFP and SASL EXTERNAL, or None.
+
+    """
+    def __init__(self, ca=None, cert=None):
+        if ssl is None:
+            raise ImportError('TLS needs pyOpenSSL and service_identity')
+        self.trust = None
+        if ca is not None:
+            self.trust = ssl.trustRootFromCertificates(load_certificates(ca))
+        self.cert = None
+        if cert is not None:
+            with open(cert) as f:
+                self.cert = ssl.PrivateCertificate.loadPEM(f.read())
+        # {hostname: ClientTLSOptions}, which each hold an SSL context
+        self.options = {}
+        # {(hostname, port): the last SSL session with that server}
+        self.sessions = {}
+
+    def creator(self, host, port):
+        """Connection creator for connectSSL to host:port."""
+        options = self.options.get(host)
+        if options is None:
+            options = self.options[host] = ssl.optionsForClientTLS(
+                unicode(host), trustRoot=self.trust,
+                clientCertificate=self.cert)
+        return ResumingCreator(options, self.sessions, (host, port))
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class ResumingCreator(object):
+    """Wraps ClientTLSOptions to offer the server our last session."""
+
+    def __init__(self, options, sessions, key):
+        self.options = options
+        self.sessions = sessions
+        self.key = key
+        self.connection = None
+        # Whether the server took us up on the session we offered, None if
+        # that's unknown
+        self.resumed = False
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        self.connection = self.options.clientConnectionForTLS(tlsProtocol)
+        session = self.sessions.get(self.key)
+        if session is not None:
+            self.connection.set_session(session)
+        return self.connection
+
+    def handshake_done(self):
+        """Remember the session for the next connection."""
+        self.resumed = session_reused(self.connection)
+        self.sessions[self.key] = self.connection.get_session()
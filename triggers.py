@@ -0,0 +1,282 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Matching channel text against the triggers of every plug at once.
+
+Plugs list keywords and regexes in their triggers attribute instead of
+searching every line themselves.  TriggerRegistry compiles them all:
+
+* keywords go into a single Aho-Corasick automaton, so a line is scanned
+  once no matter how many keywords there are.  Keywords are matched case
+  insensitively, and only as whole words where they start or end with a
+  letter or digit.
+* regexes that contain a literal run of a few characters outside of any
+  group or repetition have that literal added to the same automaton, and
+  are only tried on lines where it occurs.  The rest are or'ed together
+  into a few combined patterns that act as a gate; only when a gate
+  matches are its regexes tried one by one.
+
+"""
+
+import re
+import sre_constants
+import sre_parse
+
+
+# Python 2's re can't handle more groups than this in one pattern.
+MAX_GROUPS = 90
+# Regexes that can't be or'ed with others without changing what they match
+# or breaking the combined pattern: backreferences are renumbered, inline
+# flags apply to the whole pattern and group names may only occur once.
+UNGATEABLE = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?[iLmsux]+\)')
+# Literals shorter than this occur in too many lines to be worth it.
+MIN_LITERAL = 3
+
+
+def required_literal(regex):
+    """The longest literal every match of regex contains, lowercased.
+
+    Only looks at the top level of the pattern.  Returns None if there's
+    nothing of at least MIN_LITERAL characters.
+
+    """
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (re.error, sre_constants.error):
+        return None
+    best = run = u''
+    for op, arg in parsed:
+        if op == sre_constants.LITERAL:
+            run += unichr(arg)
+            if len(run) > len(best):
+                best = run
+        else:
+            run = u''
+    if len(best) < MIN_LITERAL:
+        return None
+    return best.lower()
+
+
+class Automaton(object):
+    """Aho-Corasick automaton over a set of lowercase keywords."""
+
+    def __init__(self, keywords):
+        # State 0 is the root; goto[state] maps a character to the next state
+        # and out[state] lists the keywords that end there.
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for keyword in keywords:
+            self.add(keyword)
+        self.link()
+
+    def add(self, keyword):
+        state = 0
+        for char in keyword:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.out[state].append(keyword)
+
+    def link(self):
+        """Fill in the failure links, breadth first."""
+        queue = list(self.goto[0].itervalues())
+        for state in queue:
+            for char, child in self.goto[state].iteritems():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.out[child] += self.out[self.fail[child]]
+
+    def search(self, text):
+        """Yield (start, keyword) for every keyword occurring in text."""
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for keyword in out[state]:
+                yield i - len(keyword) + 1, keyword
+
+
+def word_at(text, start, keyword):
+    """Whether keyword at start isn't part of a longer word."""
+    end = start + len(keyword)
+    if keyword[0].isalnum() and start > 0 and text[start - 1].isalnum():
+        return False
+    if keyword[-1].isalnum() and end < len(text) and text[end].isalnum():
+        return False
+    return True
+
+
+class TriggerRegistry(object):
+    """All plugs' triggers, compiled for matching.
+
+    A trigger is either a string, matched as a keyword, or a compiled
+    regex, which is searched for.  The compiled form is rebuilt lazily after
+    triggers are added or removed.
+
+    """
+    def __init__(self):
+        # [(trigger, plug)] in the order they were added
+        self.entries = []
+        self.keywords = {}
+        # {literal: [(regex, [plug])]} for regexes only
+        # tried on lines containing literal
+        self.prefiltered = {}
+        self.automaton = None
+        # [(gate or None, [(regex, [plug])])]
+        self.gates = []
+        self.stale = False
+
+    def add(self, trigger, plug):
+        self.entries.append((trigger, plug))
+        self.stale = True
+
+    def remove(self, trigger, plug):
+        if (trigger, plug) in self.entries:
+            self.entries.remove((trigger, plug))
+            self.stale = True
+
+    def remove_plug(self, plug):
+        entries = [entry for entry in self.entries if entry[1] is not plug]
+        if len(entries) != len(self.entries):
+            self.entries = entries
+            self.stale = True
+
+    def compile(self):
+        self.keywords = {}
+        self.prefiltered = {}
+        regexes = {}
+        for trigger, plug in self.entries:
+            if isinstance(trigger, basestring):
+                self.keywords.setdefault(trigger.lower(), []).append(
+                    (trigger, plug))
+            else:
+                regexes.setdefault(trigger, []).append(plug)
+        # Regexes that can't be prefiltered can only share a gate with
+        # regexes compiled with the same flags, and no gate can have too
+        # many groups.
+        self.gates = []
+        chunks = {}
+        for regex, plugs in regexes.iteritems():
+            literal = required_literal(regex)
+            if literal is not None:
+                self.prefiltered.setdefault(literal, []).append(
+                    (regex, plugs))
+                continue
+            if UNGATEABLE.search(regex.pattern):
+                self.gates.append((None, [(regex, plugs)]))
+                continue
+            chunk = chunks.get(regex.flags)
+            if chunk is None or chunk[0] + regex.groups > MAX_GROUPS:
+                chunk = chunks[regex.flags] = [0, []]
+                self.gates.append(chunk)
+            chunk[0] += regex.groups
+            chunk[1].append((regex, plugs))
+        for i, (groups, members) in enumerate(self.gates):
+            if groups is None or len(members) == 1:
+                # Nothing to gain from a gate for a single regex.
+                self.gates[i] = (None, members)
+                continue
+            try:
+                gate = re.compile('|'.join('(?:%s)' % (regex.pattern,)
+                                  for regex, plugs in members),
+                                  members[0][0].flags)
+            except (re.error, sre_constants.error):
+                # Whatever it is, the regexes are fine on their own.
+                gate = None
+            self.gates[i] = (gate, members)
+        literals = set(self.keywords) | set(self.prefiltered)
+        self.automaton = Automaton(literals) if literals else None
+        self.stale = False
+
+    def match(self, text):
+        """Return [(plug, trigger, match)] for every trigger in text.
+
+        match is the regex's match object, or None for keywords.  Each
+        trigger is reported once per plug, however often it occurs.
+
+        """
+        if self.stale:
+            self.compile()
+        found = []
+        candidates = []
+        if self.automaton is not None:
+            lowered = text.lower()
+            tried = set()
+            hit = set()
+            for start, literal in self.automaton.search(lowered):
+                if literal in self.prefiltered and literal not in tried:
+                    tried.add(literal)
+                    candidates.extend(self.prefiltered[literal])
+                if (literal in self.keywords and literal not in hit
+                        and word_at(lowered, start, literal)):
+                    hit.add(literal)
+                    for trigger, plug in self.keywords[literal]:
+                        found.append((plug, trigger, None))
+        for regex, plugs in candidates:
+            match = regex.search(text)
+            if match is not None:
+                for plug in plugs:
+                    found.append((plug, regex, match))
+        for gate, members in self.gates:
+            if gate is not None and not gate.search(text):
+                continue
+            for regex, plugs in members:
+                match = regex.search(text)
+                if match is not None:
+                    for plug in plugs:
+                        found.append((plug, regex, match))
+        return found
+
+
+if __name__ == '__main__':
+    # Benchmark: 2000 keywords and 200 regexes against 20k lines.
+    import random
+    import string
+    import time
+
+    random.seed(1)
+    words = [''.join(random.choice(string.ascii_lowercase)
+                     for j in xrange(random.randint(4, 10)))
+             for i in xrange(5000)]
+    registry = TriggerRegistry()
+    for word in words[:2000]:
+        registry.add(word, 'plug')
+    regexes = [re.compile(r'\b%s\d+' % (word,)) for word in words[2000:2200]]
+    for regex in regexes:
+        registry.add(regex, 'plug')
+    lines = [' '.join(random.choice(words[1000:]) for j in xrange(12))
+             for i in xrange(20000)]
+
+    start = time.time()
+    registry.compile()
+    compiled = time.time() - start
+    start = time.time()
+    matched = sum(len(registry.match(line)) for line in lines)
+    elapsed = time.time() - start
+    print 'compiled %d triggers in %.1f ms' % (len(registry.entries),
+                                               compiled * 1000)
+    print '%d matches in %d lines in %.1f ms (%.1f us/line)' % (
+        matched, len(lines), elapsed * 1000, elapsed * 1e6 / len(lines))
+
+    # The naive approach: every trigger searched separately.
+    naive = [re.compile(r'\b%s\b' % (re.escape(word),), re.I)
+             for word in words[:2000]] + regexes
+    sample = lines[:200]
+    start = time.time()
+    for line in sample:
+        [r for r in naive if r.search(line)]
+    elapsed = time.time() - start
+    print 'naive: %.1f us/line' % (elapsed * 1e6 / len(sample))
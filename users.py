@@ -2,17 +2,53 @@
 # See LICENSE for details.
 
 import logging
+import re
+import string
+
+from twisted.internet import reactor
+
+
+def _casemapping(extra_upper, extra_lower):
+    """Build (unicode, bytes) translation tables that fold to lowercase."""
+    upper = string.ascii_uppercase + extra_upper
+    lower = string.ascii_lowercase + extra_lower
+    return (dict(zip(map(ord, upper), map(ord, lower))),
+            string.maketrans(upper, lower))
+
+# The CASEMAPPING values from RPL_ISUPPORT that we know how to handle.
+CASEMAPPINGS = {
+    'ascii': _casemapping('', ''),
+    'rfc1459': _casemapping('[]\\~', '{}|^'),
+    'strict-rfc1459': _casemapping('[]\\', '{}|'),
+}
+
+# The quit message of a user lost in a netsplit: the two servers that split,
+# or '*.net *.split' on networks that hide their servers.
+SPLIT_QUIT = re.compile(r'^[\w*-]+(\.[\w*-]+)+ [\w*-]+(\.[\w*-]+)+$')
 
 
 class User(object):
+    """A user the bot shares at least one channel with.
+
+    account is the services account the user is logged in as, '*' if they're
+    known not to be logged in and None if we simply don't know.  away is the
+    away message, or None.  key is the casefolded nickname the user is
+    indexed under, and channels holds casefolded channel names.  split is
+    the quit message of the netsplit the user is lost in, or None.
+
+    """
     _uid = 0
 
-    def __init__(self, nickname, username, hostmask, channel):
+    def __init__(self, nickname, username, hostmask, channel, account=None):
         self.nickname = nickname
         self.username = username
         self.hostmask = hostmask
         self.channels = set([channel])
+        self.key = None
+        self.account = account
+        self.away = None
         self.alive = True
+        self.split = None
         self.uid = self.next_uid()
 
     @classmethod
@@ -32,27 +68,99 @@ class Users(object):
     with. It is recommended that plugs don't keep single User objects around
     but instead at most a reference to the collective users dict.
 
+    Nicknames and channels are compared the way the server does it, which
+    is described by the CASEMAPPING token in RPL_ISUPPORT.  users_by_nick is
+    keyed on the folded nickname; use fold() to get at it directly.
+
+    Users that quit in a netsplit aren't deleted but parked in split for up
+    to split_timeout seconds.  When they come back from the same host they
+    get their old User back, with its uid and whatever plugs stored on it.
+    Plugs see a single netsplit event for all users lost in a split and a
+    single netjoin event for those that came back, each sent batch_delay
+    seconds after the first user in it.  While parked, users are still
+    found by uid but not by nick.
+
     """
-    def __init__(self, core):
+    def __init__(self, core, split_timeout=1800, batch_delay=1):
         self.log = logging.getLogger('Users')
         self.core = core
         self.users_by_nick = {}
         self.users_by_uid = {}
+        self.split_timeout = split_timeout
+        self.batch_delay = batch_delay
+        # {folded nick: User} for users lost in a netsplit
+        self.split = {}
+        # {quit message: DelayedCall} expiring the users lost in each split
+        self.split_expiry = {}
+        # {quit message: [User]} waiting for the netsplit/netjoin event
+        self.splitting = {}
+        self.joining = {}
+        self.batches = []
+        self.set_casemapping('rfc1459')
+
+    def set_casemapping(self, casemapping, names=None):
+        """Switch to the named casemapping and reindex if necessary.
+
+        names maps the old folded channel names to the channel names as the
+        server spelled them, so they can be folded again.
+
+        """
+        names = names or {}
+        if casemapping not in CASEMAPPINGS:
+            self.log.warning('Unknown casemapping %s, using rfc1459.'
+                % (casemapping,))
+            casemapping = 'rfc1459'
+        self.casemapping = casemapping
+        self._fold_unicode, self._fold_bytes = CASEMAPPINGS[casemapping]
+        users = self.users_by_nick.values()
+        self.users_by_nick = {}
+        for user in users:
+            user.key = self.fold(user.nickname)
+            user.channels = set(self.fold(names.get(c, c))
+                                for c in user.channels)
+            self.users_by_nick[user.key] = user
+        split = self.split.values()
+        self.split = {}
+        for user in split:
+            user.key = self.fold(user.nickname)
+            self.split[user.key] = user
+
+    def fold(self, name):
+        """Return the casefolded form of a nickname or channel."""
+        if isinstance(name, unicode):
+            return name.translate(self._fold_unicode)
+        return name.translate(self._fold_bytes)
 
     def by_nick(self, nickname):
-        return self.users_by_nick.get(nickname)
+        return self.users_by_nick.get(self.fold(nickname))
 
     def by_uid(self, uid):
         return self.users_by_uid.get(uid)
 
-    def user_joined(self, nickname, username, hostmask, channel):
-        if nickname in self.users_by_nick:
-            self.users_by_nick[nickname].channels.add(channel)
+    def user_joined(self, nickname, username, hostmask, channel,
+                    account=None):
+        key = self.fold(nickname)
+        channel = self.fold(channel)
+        if key in self.users_by_nick:
+            user = self.users_by_nick[key]
+            user.channels.add(channel)
+            if account is not None:
+                user.account = account
             self.log.debug('Added user %s to channel %s'
                 % (nickname, channel))
+        elif key in self.split:
+            user = self.split.pop(key)
+            if user.username != username or user.hostmask != hostmask:
+                # Someone else took the nick.
+                self.delete_user(user)
+                self.user_joined(nickname, username, hostmask, channel,
+                                 account)
+                return
+            self.rejoin(user, channel, account)
         else:
-            user = User(nickname, username, hostmask, channel)
-            self.users_by_nick[nickname] = user
+            user = User(nickname, username, hostmask, channel, account)
+            user.key = key
+            self.users_by_nick[key] = user
             self.users_by_uid[user.uid] = user
             self.core.event_usercreated(user)
             msg = 'Added user %s (uid=%d) to the global userlist, channel %s'
@@ -60,31 +168,115 @@ class Users(object):
 
     def user_left(self, nickname, channel):
         """A user is no longer in a channel due to a part or kick."""
-        if nickname in self.users_by_nick:
-            user = self.users_by_nick[nickname]
-            user.channels.discard(channel)
+        user = self.by_nick(nickname)
+        if user:
+            user.channels.discard(self.fold(channel))
             self.log.debug('Removed channel %s from user %s'
                 % (channel, nickname))
             if not user.channels:
                 self.delete_user(user)
 
-    def user_quit(self, nickname):
-        """A user has quit."""
-        if nickname in self.users_by_nick:
-            user = self.users_by_nick[nickname]
+    def user_quit(self, nickname, message=None):
+        """A user has quit, possibly in a netsplit."""
+        user = self.by_nick(nickname)
+        if user:
             user.channels.clear()
+            if message and SPLIT_QUIT.match(message):
+                self.park(user, message)
+            else:
+                self.delete_user(user)
+
+    def park(self, user, message):
+        """Keep a user lost in a netsplit around until they're back."""
+        del self.users_by_nick[user.key]
+        user.split = message
+        self.split[user.key] = user
+        if message not in self.split_expiry:
+            self.log.info('Netsplit: %s' % (message,))
+            self.split_expiry[message] = reactor.callLater(
+                self.split_timeout, self.split_expired, message)
+        self.batch(self.splitting, message, user, self.core.event_netsplit)
+
+    def rejoin(self, user, channel, account):
+        """Restore a user that comes back from a netsplit."""
+        message, user.split = user.split, None
+        user.channels.add(channel)
+        if account is not None:
+            user.account = account
+        self.users_by_nick[user.key] = user
+        self.batch(self.joining, message, user, self.core.event_netjoin)
+        self.log.debug('User %s (uid=%d) is back from the split'
+            % (user.nickname, user.uid))
+
+    def batch(self, batches, message, user, event):
+        """Add user to the pending event for the split named message."""
+        if message not in batches:
+            batches[message] = []
+            self.batches.append(reactor.callLater(self.batch_delay,
+                self.send_batch, batches, message, event))
+        batches[message].append(user)
+
+    def send_batch(self, batches, message, event):
+        self.batches = [call for call in self.batches if call.active()]
+        users = batches.pop(message)
+        if users:
+            event(message, users)
+
+    def unbatch(self, user):
+        """Take a deleted user out of the pending netsplit/netjoin events."""
+        for batches in (self.splitting, self.joining):
+            for users in batches.itervalues():
+                if user in users:
+                    users.remove(user)
+
+    def split_expired(self, message):
+        """Give up on the users that didn't come back from a split."""
+        del self.split_expiry[message]
+        lost = [user for user in self.split.itervalues()
+                if user.split == message]
+        self.log.info('%d users never came back from %s'
+            % (len(lost), message))
+        for user in lost:
+            del self.split[user.key]
             self.delete_user(user)
 
+    def cancel_splits(self):
+        """Stop all timers, for when the connection's gone."""
+        for call in self.split_expiry.values() + self.batches:
+            if call.active():
+                call.cancel()
+        self.split_expiry = {}
+        self.batches = []
+
     def user_nickchange(self, oldnick, newnick):
         """A user has changed their nickname."""
-        if oldnick in self.users_by_nick:
-            user = self.users_by_nick[oldnick]
+        user = self.by_nick(oldnick)
+        if user:
+            del self.users_by_nick[user.key]
             user.nickname = newnick
-            self.users_by_nick[newnick] = user
-            del self.users_by_nick[oldnick]
+            user.key = self.fold(newnick)
+            ghost = self.users_by_nick.get(user.key)
+            if ghost:
+                # Must have missed this one leaving somehow.
+                self.delete_user(ghost)
+            self.users_by_nick[user.key] = user
             self.log.debug('Changed nickname of %s to %s'
                 % (oldnick, newnick))
 
+    def user_account(self, nickname, account):
+        """A user logged in to account, or out of it if account is '*'."""
+        user = self.by_nick(nickname)
+        if user:
+            user.account = account
+            self.core.event_useraccount(user)
+            self.log.debug('Account of %s is now %s' % (nickname, account))
+
+    def user_away(self, nickname, message):
+        """A user went away with message, or came back if it's None."""
+        user = self.by_nick(nickname)
+        if user:
+            user.away = message
+
     def delete_user(self, user):
         """Deletes a user, as far as we can from here.
 
@@ -93,7 +285,9 @@ class Users(object):
 
         """
         user.alive = False
-        del self.users_by_nick[user.nickname]
+        if self.users_by_nick.get(user.key) is user:
+            del self.users_by_nick[user.key]
         del self.users_by_uid[user.uid]
+        self.unbatch(user)
         self.core.event_userremoved(user)
         self.log.debug('Removed user %s (uid=%d)' % (user.nickname, user.uid))
@@ -13,3 +13,10 @@ class Event:
     userjoined = 'event_userjoined'
     usercreated = 'event_usercreated'
     userremoved = 'event_userremoved'
+    useraccount = 'event_useraccount'
+    userleft = 'event_userleft'
+    userquit = 'event_userquit'
+    userrenamed = 'event_userrenamed'
+    netsplit = 'event_netsplit'
+    netjoin = 'event_netjoin'
+    casemapping = 'event_casemapping'